@@ -1,213 +1,263 @@
-import json
-import logging
+import hmac
+import io
 import os
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
 
-import requests
+import orjson
 
-from lib.database import init_tables, get_leaderboard, get_nickname, get_user_stats, get_unranked_players
-from lib.slack import verify_slack_request
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+from lib.cache import response_cache
+from lib.database import (
+    init_tables, get_all_player_stats, get_user_stats,
+    get_cached_leaderboard, set_cached_leaderboard
 )
-logger = logging.getLogger('shifumi.leaderboard')
+from lib.slack import executor, parse_mention, parse_slash_command, post_response, read_slack_body, write_response
+from lib.log import get_logger
 
+logger = get_logger('shifumi.leaderboard')
 
-class handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        # Get content length to read the body
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
+# Medals for the top 3 of the leaderboard, indexed by rank
+_MEDALS = ('', "🥇", "🥈", "🥉")
 
-        # Verify request is from Slack only in production
-        if os.getenv('VERCEL_ENV') == 'production':
-            timestamp = self.headers.get('X-Slack-Request-Timestamp')
-            signature = self.headers.get('X-Slack-Signature')
+# Section headers of the leaderboard message
+_HEADER_RANKED = "🏆 *Classement de l'année* 🏆\n\n"
+_HEADER_UNRANKED = "👥 *Joueurs non classés* 👥\n"
 
-            if not timestamp or not signature or not verify_slack_request(timestamp, post_data, signature):
-                self.send_response(401)
-                self.end_headers()
-                return
+# The leaderboard message is precomputed in the database and shared by every instance.
+# Games and nicknames purge it so the next read rebuilds it, the cron refreshes it every 10 minutes
+_LEADERBOARD_KEY = 'global'
+_LEADERBOARD_MAX_AGE = 15 * 60
 
-        # Parse form data
-        params = parse_qs(post_data)
-        # Extract Slack command parameters
-        slack_params = {
-            'command': params.get('command', [''])[0],
-            'text': params.get('text', [''])[0],
-            'response_url': params.get('response_url', [''])[0],
-            'user_id': params.get('user_id', [''])[0],
-            'channel_id': params.get('channel_id', [''])[0],
+# Authorization header expected from the cron, None when CRON_SECRET is not configured
+_CRON_SECRET = os.getenv('CRON_SECRET')
+_CRON_AUTHORIZATION = f"Bearer {_CRON_SECRET}".encode('utf-8') if _CRON_SECRET else None
+
+
+def display_name(player_id, nickname, user_name):
+    """Name shown for a player: nickname and Slack handle, or a mention without nickname"""
+    return f"{nickname} (@{user_name})" if nickname else f"<@{player_id}>"
+
+
+def build_user_stats(target_user_id):
+    """Build the stats message of a user, as a (text, blocks) tuple"""
+    # Get user stats
+    stats = get_user_stats(target_user_id)
+
+    if not stats or stats['total_games'] == 0:
+        return f"<@{target_user_id}> n'a pas encore joué cette année ! 😢", None
+
+    # Nickname comes joined from the stats query, fallback to mention
+    user_name = stats['nickname'] or f"<@{target_user_id}>"
+
+    blocks = [
+        {
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": f"📊 Statistiques de {user_name} 📊",
+                "emoji": True
+            }
+        },
+        {
+            "type": "section",
+            "fields": [
+                {
+                    "type": "mrkdwn",
+                    "text": "*Victoires* " + f"`{stats['wins']}`"
+                },
+                {
+                    "type": "mrkdwn",
+                    "text": "*Défaites* " + f"`{stats['losses']}`"
+                },
+                {
+                    "type": "mrkdwn",
+                    "text": "*Egalités* " + f"`{stats['draws']}`"
+                },
+                {
+                    "type": "mrkdwn",
+                    "text": "*Total parties* " + f"`{stats['total_games']}`"
+                },
+                {
+                    "type": "mrkdwn",
+                    "text": "*Taux de victoire* " + f"`{stats['win_rate']}%`"
+                }
+            ]
         }
+    ]
+
+    # Add relationships section if any exist
+    relationships = []
+
+    if stats['nemesis']:
+        nemesis_name = stats['nemesis']['nickname'] or f"<@{stats['nemesis']['user_id']}>"
+        relationships.append(f"☠️ *Némésis*: {nemesis_name} ({stats['nemesis']['user_name']}) ({stats['nemesis']['wins']} victoires)")
 
-        logger.info(f"Received leaderboard request from user {slack_params['user_id']}")
+    if stats['best_against']:
+        best_against_name = stats['best_against']['nickname'] or f"<@{stats['best_against']['user_id']}>"
+        relationships.append(
+            f"💪 *Meilleur contre*: {best_against_name} ({stats['best_against']['user_name']}) ({stats['best_against']['wins']} victoires)")
+
+    if stats['most_draws']:
+        most_draws_name = stats['most_draws']['nickname'] or f"<@{stats['most_draws']['user_id']}>"
+        relationships.append(
+            f"🤝 *Égalités avec*: {most_draws_name} ({stats['most_draws']['user_name']}) ({stats['most_draws']['draws']} égalités)")
+
+    if relationships:
+        blocks.append({"type": "divider"})
+        blocks.append({
+            "type": "section",
+            "fields": [
+                {"type": "mrkdwn", "text": rel}
+                for rel in relationships
+            ]
+        })
+
+    return None, blocks  # Fallback text not needed with blocks
+
+
+def build_leaderboard():
+    """Build the text of this year's leaderboard"""
+    # Get leaderboard and unranked data, both come from a single query
+    leaderboard, unranked = get_all_player_stats()
+
+    if not leaderboard and not unranked:
+        return "Aucune partie jouée cette année ! 😢"
+
+    # Every line is written followed by a newline, the last one is trimmed at the end
+    buf = io.StringIO()
+
+    # Format ranked players
+    if leaderboard:
+        buf.write(_HEADER_RANKED)
+
+        for i, player in enumerate(leaderboard, 1):
+            # Nickname comes joined from the leaderboard query
+            player_name = display_name(player['player_id'], player['nickname'], player['user_name'])
+
+            # Add medal for top 3
+            medal = _MEDALS[i] if i < len(_MEDALS) else ''
+            total_games = player['wins'] + player['losses'] + player['draws']
+            buf.write(
+                f"{i}. {player_name} {medal} - "
+                f"{player['wins']}W/{player['losses']}L "
+                f"({player['win_rate']}% sur {total_games} parties)\n"
+            )
+
+    # Format unranked players
+    if unranked:
+        if leaderboard:  # Add spacing if there were ranked players
+            buf.write("\n")
+        buf.write(_HEADER_UNRANKED)
+        for player in unranked:
+            player_name = display_name(player['player_id'], player['nickname'], player['player_name'])
+            buf.write(
+                f"• {player_name} - "
+                f"{player['games_played']}/5 parties jouées "
+                f"(encore {player['games_needed']} parties)\n"
+            )
 
+    return buf.getvalue()[:-1]
+
+
+def build_response_body(text, blocks=None):
+    """Serialize an in-channel message, blocks are only sent when there is no text"""
+    response_message = {
+        'response_type': 'in_channel',
+        'blocks': blocks if not text else None,
+        'text': text if text else None
+    }
+    return orjson.dumps(response_message)
+
+
+def refresh_leaderboard(version):
+    """Build the leaderboard message and store it for every instance.
+    version is the stored version read beforehand, the message is not stored if it was purged meanwhile"""
+    body = build_response_body(build_leaderboard())
+    set_cached_leaderboard(_LEADERBOARD_KEY, body, version)
+    return body
+
+
+def load_leaderboard():
+    """Get the precomputed leaderboard message, rebuilding it if it is missing or outdated"""
+    body, version = get_cached_leaderboard(_LEADERBOARD_KEY, _LEADERBOARD_MAX_AGE)
+    return body or refresh_leaderboard(version)
+
+
+def send_leaderboard(command):
+    """Build the leaderboard (or a user's stats) and post it to the Slack response_url.
+    Runs on the worker pool so the slash command can be acknowledged right away"""
+    # Check if a user was specified
+    text = command.text.strip()
+    response_url = command.response_url
+    try:
         # Initialize tables if needed
         init_tables()
 
-        # Check if a user was specified
-        text = slack_params['text'].strip()
-        blocks = None
-        try:
-            if text and text.startswith('<@'):
-                # Extract user ID from mention
-                target_user_id = text[2:-1].split('|')[0]
-                # Get user stats
-                stats = get_user_stats(target_user_id)
-
-                if not stats or stats['total_games'] == 0:
-                    text = f"<@{target_user_id}> n'a pas encore joué cette année ! 😢"
-                else:
-                    # Get user nickname or fallback to mention
-                    user_name = get_nickname(target_user_id) or f"<@{target_user_id}>"
-
-                    blocks = [
-                        {
-                            "type": "header",
-                            "text": {
-                                "type": "plain_text",
-                                "text": f"📊 Statistiques de {user_name} 📊",
-                                "emoji": True
-                            }
-                        },
-                        {
-                            "type": "section",
-                            "fields": [
-                                {
-                                    "type": "mrkdwn",
-                                    "text": "*Victoires* " + f"`{stats['wins']}`"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": "*Défaites* " + f"`{stats['losses']}`"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": "*Egalités* " + f"`{stats['draws']}`"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": "*Total parties* " + f"`{stats['total_games']}`"
-                                },
-                                {
-                                    "type": "mrkdwn",
-                                    "text": "*Taux de victoire* " + f"`{stats['win_rate']}%`"
-                                }
-                            ]
-                        }
-                    ]
-
-                    # Add relationships section if any exist
-                    relationships = []
-
-                    if stats['nemesis']:
-                        nemesis_name = get_nickname(stats['nemesis']['user_id']) or f"<@{stats['nemesis']['user_id']}>"
-                        relationships.append(f"☠️ *Némésis*: {nemesis_name} ({stats['nemesis']['user_name']}) ({stats['nemesis']['wins']} victoires)")
-
-                    if stats['best_against']:
-                        best_against_name = get_nickname(
-                            stats['best_against']['user_id']) or f"<@{stats['best_against']['user_id']}>"
-                        relationships.append(
-                            f"💪 *Meilleur contre*: {best_against_name} ({stats['best_against']['user_name']}) ({stats['best_against']['wins']} victoires)")
-
-                    if stats['most_draws']:
-                        most_draws_name = get_nickname(
-                            stats['most_draws']['user_id']) or f"<@{stats['most_draws']['user_id']}>"
-                        relationships.append(
-                            f"🤝 *Égalités avec*: {most_draws_name} ({stats['most_draws']['user_name']}) ({stats['most_draws']['draws']} égalités)")
-
-                    if relationships:
-                        blocks.append({"type": "divider"})
-                        blocks.append({
-                            "type": "section",
-                            "fields": [
-                                {"type": "mrkdwn", "text": rel}
-                                for rel in relationships
-                            ]
-                        })
-
-                    text = None  # Fallback text not needed with blocks
-            else:
-                # Get leaderboard and unranked data
-                leaderboard = get_leaderboard()
-                unranked = get_unranked_players()
-
-                lines = []
-
-                # Format ranked players
-                if leaderboard:
-                    lines.append("🏆 *Classement de l'année* 🏆\n")
-
-                    for i, player in enumerate(leaderboard, 1):
-                        # Get player nickname and username
-                        nickname = get_nickname(player['player_id'])
-                        player_name = f"{nickname} (@{player['user_name']})" if nickname else f"<@{player['player_id']}>"
-
-                        # Add medal for top 3
-                        medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(i, '')
-                        total_games = player['wins'] + player['losses'] + player['draws']
-                        lines.append(
-                            f"{i}. {player_name} {medal} - "
-                            f"{player['wins']}W/{player['losses']}L "
-                            f"({player['win_rate']}% sur {total_games} parties)"
-                        )
-
-                # Format unranked players
-                if unranked:
-                    if lines:  # Add spacing if there were ranked players
-                        lines.append("")
-                    lines.append("👥 *Joueurs non classés* 👥")
-                    for player in unranked:
-                        nickname = get_nickname(player['player_id'])
-                        player_name = f"{nickname} (@{player['player_name']})" if nickname else f"<@{player['player_id']}>"
-                        lines.append(
-                            f"• {player_name} - "
-                            f"{player['games_played']}/5 parties jouées "
-                            f"(encore {player['games_needed']} parties)"
-                        )
-                if not leaderboard and not unranked:
-                    text = "Aucune partie jouée cette année ! 😢"
-                    blocks = None
-                else:
-                    text = "\n".join(lines)
-                    blocks = None
-
-            response_message = {
-                'response_type': 'in_channel',
-                'blocks': blocks if not text else None,
-                'text': text if text else None
-            }
+        # Extract user ID from mention
+        target_user_id = parse_mention(text)
 
-            # Send delayed response with leaderboard
-            logger.info(f'Sending response to Slack: {json.dumps(response_message["blocks"])[:100]}...')
-            logger.info(f'Message size : {len(json.dumps(response_message))}')
-            requests.post(
-                slack_params['response_url'],
-                json=response_message,
+        # The serialized payload is cached, so cache hits are sent as is
+        if target_user_id:
+            body = response_cache.get_or_set(
+                f'lb:user:{target_user_id}', lambda: build_response_body(*build_user_stats(target_user_id))
             )
+        else:
+            body = response_cache.get_or_set('lb:global', load_leaderboard)
+
+        # Send delayed response with leaderboard
+        logger.info('Sending response to Slack: %s... (%d bytes)', body[:100], len(body))
+        post_response(response_url, body, command.channel_id)
+        logger.info('Request completed successfully')
+
+    except Exception as e:
+        logger.error('Error processing request: %s', e, exc_info=True)
+        error_response = {
+            'response_type': 'ephemeral',
+            'text': f"Une erreur s'est produite: {str(e)}"
+        }
+        try:
+            post_response(response_url, orjson.dumps(error_response))
+        except Exception:
+            logger.exception('Error posting the error message to Slack')
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # Read the body, verifying the request is from Slack in production
+        post_data = read_slack_body(self)
+        if post_data is None:
+            return
+
+        # Parse form data
+        command = parse_slash_command(post_data)
 
-            # Send immediate empty response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'')
-            logger.info('Request completed successfully')
+        logger.info('Received leaderboard request from user %s', command.user_id)
 
+        # Acknowledge right away, Slack only waits 3 seconds for slash commands
+        write_response(self, 200)
+
+        # Leaderboard messages are built and sent after the request has been acknowledged
+        executor.submit(send_leaderboard, command)
+        return
+
+    def do_GET(self):
+        # Called by the Vercel cron to keep the precomputed leaderboard fresh,
+        # Vercel sends the CRON_SECRET as a bearer token. Without a secret nobody can refresh it
+        authorization = self.headers.get('Authorization', '').encode('utf-8')
+        if not _CRON_AUTHORIZATION or not hmac.compare_digest(authorization, _CRON_AUTHORIZATION):
+            write_response(self, 401)
+            return
+
+        try:
+            init_tables()
+            _, version = get_cached_leaderboard(_LEADERBOARD_KEY, 0)
+            refresh_leaderboard(version)
         except Exception as e:
-            logger.error(f'Error processing request: {str(e)}', exc_info=True)
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            error_response = {
-                'response_type': 'ephemeral',
-                'text': f"Une erreur s'est produite: {str(e)}"
-            }
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+            logger.error('Error refreshing leaderboard: %s', e, exc_info=True)
+            write_response(self, 500)
+            return
 
+        logger.info('Leaderboard refreshed')
+        write_response(self, 200)
         return
 
 
@@ -1,63 +1,72 @@
-import json
+import io
 from http.server import BaseHTTPRequestHandler
-import os
-from lib.database import init_tables, get_pending_challenges, get_nickname
-from lib.slack import verify_slack_request
-from datetime import datetime
 
+import orjson
 
-class handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        # Get content length to read the body
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
+from lib.database import init_tables, get_pending_challenges, get_nicknames
+from lib.slack import read_slack_body, write_response
+from lib.cache import response_cache
+
+# Header and empty message of the pending challenges list
+_HEADER = "🎯 *Défis en attente* 🎯\n"
+_NO_CHALLENGES = "Aucun défi en attente ! 🎮"
+
+
+def build_pending_text():
+    """Build the text listing the pending challenges"""
+    # Get pending challenges
+    challenges = get_pending_challenges()
+
+    if not challenges:
+        return _NO_CHALLENGES
+
+    # Fetch the nicknames of every player at once
+    nicknames = get_nicknames(
+        [challenge['challenger_id'] for challenge in challenges]
+        + [challenge['opponent_id'] for challenge in challenges]
+    )
+
+    # Every line is written followed by a newline, the last one is trimmed at the end
+    buf = io.StringIO()
+    buf.write(_HEADER)
+    buf.write("\n")
 
-        # Verify request is from Slack only in production
-        if os.getenv('VERCEL_ENV') == 'production':
-            timestamp = self.headers.get('X-Slack-Request-Timestamp')
-            signature = self.headers.get('X-Slack-Signature')
+    for challenge in challenges:
+        # Get nicknames or fallback to mentions
+        challenger = nicknames.get(challenge['challenger_id']) or f"<@{challenge['challenger_id']}>"
+        opponent = nicknames.get(challenge['opponent_id']) or f"<@{challenge['opponent_id']}>"
 
-            if not timestamp or not signature or not verify_slack_request(timestamp, post_data, signature):
-                self.send_response(401)
-                self.end_headers()
-                return
+        # Format creation time
+        time_str = challenge['created_at'].strftime("%H:%M")
+
+        buf.write(f"• {challenger} → {opponent} (depuis {time_str})\n")
+
+    return buf.getvalue()[:-1]
+
+
+def build_pending_body():
+    """Serialize the in-channel message listing the pending challenges"""
+    response = {
+        'response_type': 'in_channel',
+        'text': build_pending_text()
+    }
+    return orjson.dumps(response)
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # Read the body, verifying the request is from Slack in production.
+        # The command has no parameters, the body is not used further
+        if read_slack_body(self) is None:
+            return
 
         # Initialize tables if needed
         init_tables()
 
-        # Get pending challenges
-        challenges = get_pending_challenges()
-        
-        if not challenges:
-            text = "Aucun défi en attente ! 🎮"
-        else:
-            lines = ["🎯 *Défis en attente* 🎯\n"]
-            
-            for challenge in challenges:
-                # Get nicknames or fallback to mentions
-                challenger = get_nickname(challenge['challenger_id']) or f"<@{challenge['challenger_id']}>"
-                opponent = get_nickname(challenge['opponent_id']) or f"<@{challenge['opponent_id']}>"
-                
-                # Format creation time
-                created_at = challenge['created_at']
-                time_str = created_at.strftime("%H:%M")
-                
-                lines.append(
-                    f"• {challenger} → {opponent} "
-                    f"(depuis {time_str})"
-                )
-            
-            text = "\n".join(lines)
+        # The serialized response is cached per instance, cache hits are sent as is.
+        # Games written by this instance clear it, games from other instances show up within the cache TTL
+        body = response_cache.get_or_set('pending', build_pending_body)
 
         # Send response
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        
-        response = {
-            'response_type': 'in_channel',
-            'text': text
-        }
-        
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+        write_response(self, 200, body)
         return
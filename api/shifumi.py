@@ -1,260 +1,171 @@
-import json
-import logging
 from http.server import BaseHTTPRequestHandler
-import requests
-from urllib.parse import parse_qs
-import os
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger('shifumi.game')
-from lib.database import (
-    init_tables, create_game,
-    get_pending_challenge, get_nickname
-)
-from lib.slack import verify_slack_request
+import orjson
+
+from lib.database import init_tables, create_challenge, create_game, get_nickname
+from lib.slack import executor, parse_mention, parse_slash_command, post_response, read_slack_body, write_response
 from lib.types import Gesture
+from lib.log import get_logger
 
+logger = get_logger('shifumi.game')
 
-class handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        # Get content length to read the body
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
+# Buttons offered to the opponent, as (label, action_id)
+_MOVE_BUTTONS = (
+    ('🪨 Pierre', 'play_rock'),
+    ('🍃 Feuille', 'play_paper'),
+    ('✂️ Ciseaux', 'play_scissors'),
+)
 
-        # Verify request is from Slack only in production
-        if os.getenv('VERCEL_ENV') == 'production':
-            timestamp = self.headers.get('X-Slack-Request-Timestamp')
-            signature = self.headers.get('X-Slack-Signature')
+# Static replies to invalid commands, serialized once
+_INVALID_GESTURE_BODY = orjson.dumps({
+    'response_type': 'ephemeral',
+    'text': "Geste invalide ! Valeurs possibles : :rock:, :leaves:, :scissors: (ou PIERRE, FEUILLE, CISEAUX)"
+})
+_SELF_CHALLENGE_BODY = orjson.dumps({
+    'response_type': 'ephemeral',
+    'text': "Tu ne peux pas te défier toi-même !"
+})
+
+# Placeholders of the serialized game message, filled in for each game
+_TEXT_PLACEHOLDER = '__TEXT__'
+_GAME_ID_PLACEHOLDER = '__GAME_ID__'
+_TEXT_JSON = orjson.dumps(_TEXT_PLACEHOLDER)
+_GAME_ID_JSON = orjson.dumps(_GAME_ID_PLACEHOLDER)
+
+# The game message only differs by its text and the game ID held by the buttons,
+# so it is serialized once and the placeholders are substituted in the JSON bytes
+_GAME_MESSAGE_TEMPLATE = orjson.dumps({
+    'response_type': 'in_channel',
+    'text': _TEXT_PLACEHOLDER,
+    'blocks': [
+        {
+            'type': 'section',
+            'text': {
+                'type': 'mrkdwn',
+                'text': _TEXT_PLACEHOLDER
+            }
+        },
+        {
+            'type': 'actions',
+            'elements': [
+                {
+                    'type': 'button',
+                    'text': {
+                        'type': 'plain_text',
+                        'text': label,
+                        'emoji': True
+                    },
+                    'value': _GAME_ID_PLACEHOLDER,
+                    'action_id': action_id
+                }
+                for label, action_id in _MOVE_BUTTONS
+            ]
+        }
+    ]
+})
 
-            if not timestamp or not signature or not verify_slack_request(timestamp, post_data, signature):
-                self.send_response(401)
-                self.end_headers()
-                return
 
-        # Parse form data
-        params = parse_qs(post_data)
-        # Extract Slack command parameters
-        slack_params = {
-            'command': params.get('command', [''])[0],
-            'text': params.get('text', [''])[0],
-            'response_url': params.get('response_url', [''])[0],
-            'trigger_id': params.get('trigger_id', [''])[0],
-            'user_id': params.get('user_id', [''])[0],
-            'user_name': params.get('user_name', [''])[0],
-            'team_id': params.get('team_id', [''])[0],
-            'enterprise_id': params.get('enterprise_id', [''])[0],
-            'channel_id': params.get('channel_id', [''])[0],
-            'channel_name': params.get('channel_name', [''])[0],
-            'api_app_id': params.get('api_app_id', [''])[0]
-        }
+def build_game_message(text, game_id):
+    """Build the serialized in-channel message announcing a game, with a button per move for the opponent"""
+    # The game ID goes in first, the text may contain anything
+    return _GAME_MESSAGE_TEMPLATE.replace(
+        _GAME_ID_JSON, orjson.dumps(f'{game_id}')
+    ).replace(
+        _TEXT_JSON, orjson.dumps(text)
+    )
 
+
+def start_game(command, move, target_user=None):
+    """Create the game (a challenge when there is a target) and post its message to the Slack response_url.
+    Runs on the worker pool so the slash command can be acknowledged right away"""
+    try:
         # Initialize tables if needed
         init_tables()
 
-        # Parse the command text
-        text_parts = slack_params['text'].split()
-        logger.info(f"Game request from user {slack_params['user_id']}")
+        user_nickname = get_nickname(command.user_id) or f'<@{command.user_id}>'
+        logger.debug('User nickname resolved to: %s', user_nickname)
+
+        if target_user:
+            # Only one challenge at a time between two players, the check is part of the insert
+            logger.debug('Creating new challenge game with move %s', move.value)
+            game_id = create_challenge(
+                command.channel_id,
+                command.channel_name,
+                command.user_id,
+                command.user_name,
+                move.value,
+                target_user
+            )
+            if game_id is None:
+                post_response(command.response_url, {
+                    'response_type': 'ephemeral',
+                    'text': "Tu as déjà un défi en cours avec cette personne !"
+                })
+                return
+            message = build_game_message(f"{user_nickname} défie <@{target_user}> !", game_id)
+        else:
+            # Without a target, anyone in the channel can answer the game
+            game_id = create_game(
+                command.channel_id,
+                command.channel_name,
+                command.user_id,
+                command.user_name,
+                move.value
+            )
+            message = build_game_message(f"{user_nickname} a joué. En attente d'un adversaire...", game_id)
+
+        post_response(command.response_url, message, command.channel_id)
+
+    except Exception as e:
+        logger.error('Error processing request: %s', e, exc_info=True)
+        try:
+            post_response(command.response_url, {
+                'response_type': 'ephemeral',
+                'text': f"Une erreur s'est produite: {str(e)}"
+            })
+        except Exception:
+            logger.exception('Error posting the error message to Slack')
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # Read the body, verifying the request is from Slack in production
+        post_data = read_slack_body(self)
+        if post_data is None:
+            return
+
+        # Parse form data
+        command = parse_slash_command(post_data)
 
-        user_nickname = get_nickname(slack_params['user_id']) or f'<@{slack_params['user_id']}>'
-        logger.info(f"User nickname resolved to: {user_nickname}")
+        # Parse the command text, either a gesture or a mention followed by a gesture
+        first, _, rest = command.text.strip().partition(' ')
+        logger.info('Game request from user %s', command.user_id)
 
         # Check if it's a direct challenge
-        if len(text_parts) == 2 and text_parts[0].startswith('<@'):
-            target_user = text_parts[0][2:-1].split('|')[0]  # Remove <@ and >
+        target_user = parse_mention(first) if rest else None
+        if target_user:
             try:
-                move = Gesture.from_input(text_parts[1].upper())
+                move = Gesture.from_input(rest)
             except ValueError:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                response = {
-                    'response_type': 'ephemeral',
-                    'text': f"Geste invalide ! Valeurs possibles : :rock:, :leaves:, :scissors: (ou PIERRE, FEUILLE, CISEAUX)"
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                write_response(self, 200, _INVALID_GESTURE_BODY)
                 return
 
             # Prevent self-challenge
-            if target_user == slack_params['user_id']:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                response = {
-                    'response_type': 'ephemeral',
-                    'text': "Tu ne peux pas te défier toi-même !"
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+            if target_user == command.user_id:
+                write_response(self, 200, _SELF_CHALLENGE_BODY)
                 return
 
-            logger.info(f"Challenge request from {slack_params['user_id']} to {target_user}")
-            # Check if there's already a challenge
-            pending_challenge = get_pending_challenge(
-                target_user,  # The challenger
-                slack_params['user_id']  # The current player
-            )
-            logger.info(f"Pending challenge check result: {pending_challenge is not None}")
-
-            if pending_challenge and pending_challenge[0] == target_user:
-                # There's already a pending challenge from this user
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                response = {
-                    'response_type': 'ephemeral',
-                    'text': f"Tu as déjà un défi en cours avec cette personne !"
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
-                return
-            else:
-                # This is a new challenge
-                logger.info(f"Creating new challenge game with move {move.value}")
-                game_id = create_game(
-                    slack_params['channel_id'],
-                    slack_params['channel_name'],
-                    slack_params['user_id'],
-                    slack_params['user_name'],
-                    move.value,
-                    target_user,
-                    None  # We don't have the opponent's name yet
-                )
-                delayed_response = {
-                    'response_type': 'in_channel',
-                    'text': f"{user_nickname} défie <@{target_user}> !",
-                    'blocks': [
-                        {
-                            'type': 'section',
-                            'text': {
-                                'type': 'mrkdwn',
-                                'text': f"{user_nickname} défie <@{target_user}> !"
-                            }
-                        },
-                        {
-                            'type': 'actions',
-                            'elements': [
-                                {
-                                    'type': 'button',
-                                    'text': {
-                                        'type': 'plain_text',
-                                        'text': '🪨 Pierre',
-                                        'emoji': True
-                                    },
-                                    'value': f'{game_id}',
-                                    'action_id': 'play_rock'
-                                },
-                                {
-                                    'type': 'button',
-                                    'text': {
-                                        'type': 'plain_text',
-                                        'text': '🍃 Feuille',
-                                        'emoji': True
-                                    },
-                                    'value': f'{game_id}',
-                                    'action_id': 'play_paper'
-                                },
-                                {
-                                    'type': 'button',
-                                    'text': {
-                                        'type': 'plain_text',
-                                        'text': '✂️ Ciseaux',
-                                        'emoji': True
-                                    },
-                                    'value': f'{game_id}',
-                                    'action_id': 'play_scissors'
-                                }
-                            ]
-                        }
-                    ]
-                }
-
-            requests.post(slack_params['response_url'], json=delayed_response)
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'')
-            return
-
-        # Start new game
-        try:
-            move = Gesture.from_input(text_parts[0])
-        except ValueError:
-            response = {
-                'response_type': 'ephemeral',
-                'text': f"Geste invalide ! Valeurs possibles : :rock:, :leaves:, :scissors: (ou PIERRE, FEUILLE, CISEAUX)"
-            }
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(bytes(str(response), 'utf-8'))
-            return
+            logger.info('Challenge request from %s to %s', command.user_id, target_user)
+        else:
             # Start new game
-        game_id = create_game(
-            slack_params['channel_id'],
-            slack_params['channel_name'],
-            slack_params['user_id'],
-            slack_params['user_name'],
-            move.value
-        )
-        delayed_response = {
-            'response_type': 'in_channel',
-            'text': f"{user_nickname} a joué. En attente d'un adversaire...",
-            'blocks': [
-                {
-                    'type': 'section',
-                    'text': {
-                        'type': 'mrkdwn',
-                        'text': f"{user_nickname} a joué. En attente d'un adversaire..."
-                    }
-                },
-                {
-                    'type': 'actions',
-                    'elements': [
-                        {
-                            'type': 'button',
-                            'text': {
-                                'type': 'plain_text',
-                                'text': '🪨 Pierre',
-                                'emoji': True
-                            },
-                            'value': f'{game_id}',
-                            'action_id': 'play_rock'
-                        },
-                        {
-                            'type': 'button',
-                            'text': {
-                                'type': 'plain_text',
-                                'text': '🍃 Feuille',
-                                'emoji': True
-                            },
-                            'value': f'{game_id}',
-                            'action_id': 'play_paper'
-                        },
-                        {
-                            'type': 'button',
-                            'text': {
-                                'type': 'plain_text',
-                                'text': '✂️ Ciseaux',
-                                'emoji': True
-                            },
-                            'value': f'{game_id}',
-                            'action_id': 'play_scissors'
-                        }
-                    ]
-                }
-            ]
-        }
-        requests.post(
-            slack_params['response_url'],
-            json=delayed_response
-        )
-
-        # Send immediate empty 200 response
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(b'')
+            try:
+                move = Gesture.from_input(first)
+            except ValueError:
+                write_response(self, 200, _INVALID_GESTURE_BODY)
+                return
 
-        return
\ No newline at end of file
+        # Acknowledge right away, Slack only waits 3 seconds for slash commands.
+        # The game is created and its message posted after the request has been acknowledged
+        write_response(self, 200)
+        executor.submit(start_game, command, move, target_user)
+        return
@@ -1,196 +1,74 @@
-import json
-import logging
 from http.server import BaseHTTPRequestHandler
-import os
-from urllib.parse import parse_qs
-import requests
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger('shifumi.stats')
 
 from lib.database import (
-    init_tables, get_move_stats, get_nickname,
+    init_tables, get_move_stats, get_nickname, get_nicknames,
     get_player_stats, get_head_to_head_stats, get_move_stats_breakdown,
     get_head_to_head_stats_breakdown
 )
-from lib.slack import verify_slack_request
-from lib.types import Gesture
-
+from lib.slack import executor, parse_mention, parse_slash_command, post_response, read_slack_body, write_response
+from lib.types import GESTURE_BY_VALUE
+from lib.log import get_logger
 
-class handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        # Get content length to read the body
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-
-        # Verify request is from Slack only in production
-        if os.getenv('VERCEL_ENV') == 'production':
-            timestamp = self.headers.get('X-Slack-Request-Timestamp')
-            signature = self.headers.get('X-Slack-Signature')
-
-            if not timestamp or not signature or not verify_slack_request(timestamp, post_data, signature):
-                self.send_response(401)
-                self.end_headers()
-                return
-
-        # Parse form data
-        params = parse_qs(post_data)
-        # Extract Slack command parameters
-        slack_params = {
-            'command': params.get('command', [''])[0],
-            'text': params.get('text', [''])[0],
-            'response_url': params.get('response_url', [''])[0],
-            'user_id': params.get('user_id', [''])[0],
-        }
+logger = get_logger('shifumi.stats')
 
-        logger.info(f"Received stats request from user {slack_params['user_id']}")
 
+def send_stats(command):
+    """Compute the requested stats and post them to the Slack response_url.
+    Runs on the worker pool so the slash command can be acknowledged right away"""
+    response_url = command.response_url
+    try:
         # Initialize tables if needed
         init_tables()
 
-        try:
-            # Check if users are specified
-            text = slack_params.get('text', '').strip()
-            logger.info(f"Command text received: '{text}'")
+        # Check if users are specified
+        text = command.text.strip()
+        logger.debug("Command text received: '%s'", text)
+        
+        # Check for breakdown flag
+        show_breakdown = "--breakdown" in text
+        if show_breakdown:
+            text = text.replace("--breakdown", "").strip()
+            logger.info("Breakdown flag detected")
+        
+        # Split text to check for multiple user mentions
+        mentions = [user_id for user_id in map(parse_mention, text.split()) if user_id]
+        
+        if len(mentions) == 2:
+            # Head-to-head analysis
+            player1_id, player2_id = mentions
+            logger.debug('Computing head-to-head stats between %s and %s', player1_id, player2_id)
             
-            # Check for breakdown flag
-            show_breakdown = "--breakdown" in text
-            if show_breakdown:
-                text = text.replace("--breakdown", "").strip()
-                logger.info("Breakdown flag detected")
+            # Both nicknames are fetched at once
+            nicknames = get_nicknames([player1_id, player2_id])
+            player1_name = nicknames.get(player1_id) or f"<@{player1_id}>"
+            player2_name = nicknames.get(player2_id) or f"<@{player2_id}>"
+            logger.debug('Players resolved to: %s vs %s', player1_name, player2_name)
             
-            # Split text to check for multiple user mentions
-            mentions = [part for part in text.split() if part.startswith('<@')]
+            if show_breakdown:
+                stats = get_head_to_head_stats_breakdown(player1_id, player2_id)
+            else:
+                stats = get_head_to_head_stats(player1_id, player2_id)
             
-            if len(mentions) == 2:
-                # Head-to-head analysis
-                player1_id = mentions[0][2:-1].split('|')[0]
-                player2_id = mentions[1][2:-1].split('|')[0]
-                logger.info(f"Computing head-to-head stats between {player1_id} and {player2_id}")
-                
-                player1_name = get_nickname(player1_id) or f"<@{player1_id}>"
-                player2_name = get_nickname(player2_id) or f"<@{player2_id}>"
-                logger.info(f"Players resolved to: {player1_name} vs {player2_name}")
-                
-                if show_breakdown:
-                    stats = get_head_to_head_stats_breakdown(player1_id, player2_id)
-                else:
-                    stats = get_head_to_head_stats(player1_id, player2_id)
+            if not stats:
+                text = f"Aucune partie jouée entre {player1_name} et {player2_name} cette année ! 😢"
+                logger.info('No head-to-head stats found')
+            else:
+                logger.debug('Found %s games between players', stats['total_games'])
+                logger.debug("Opponent's favorite move: %s", stats['opponent_favorite'])
                 
-                if not stats:
-                    text = f"Aucune partie jouée entre {player1_name} et {player2_name} cette année ! 😢"
-                    logger.info(f"No head-to-head stats found")
-                else:
-                    logger.info(f"Found {stats['total_games']} games between players")
-                    logger.info(f"Opponent's favorite move: {stats['opponent_favorite']}")
-                    
-                    # Create text output
-                    lines = [
-                        f"🤼 *Stats de {player1_name} contre {player2_name}* 🤼\n",
-                        f"Total: `{stats['total_games']}` parties"
-                    ]
-                    
-                    if show_breakdown:
-                        # Add detailed breakdown stats for each move
-                        print(stats['moves'])
-                        for move_name in stats['moves']:
-                            print(move_name)
-                            move = Gesture(move_name)
-                            move_stats = stats['moves'][move_name]
-                            
-                            lines.append(f"\n{move.emoji} *{move.value}*")
-                            
-                            if move_stats['first']:
-                                first = move_stats['first']
-                                lines.append(
-                                    f"• En premier: "
-                                    f"`{first['wins']}W/{first['losses']}L/{first['draws']}D` "
-                                    f"(WR: {first['win_rate']}% sur {first['total_games']} parties)"
-                                )
-                            
-                            if move_stats['second']:
-                                second = move_stats['second']
-                                lines.append(
-                                    f"• En second: "
-                                    f"`{second['wins']}W/{second['losses']}L/{second['draws']}D` "
-                                    f"(WR: {second['win_rate']}% sur {second['total_games']} parties)"
-                                )
-                    else:
-                        # Add regular stats for each move
-                        for move_stat in stats['moves']:
-                            move = Gesture(move_stat['move'])
-                            logger.info(f"Processing stats for {move.value}: "
-                                      f"W/L/D: {move_stat['wins']}/{move_stat['losses']}/{move_stat['draws']}")
-                            
-                            lines.append(
-                                f"{move.emoji} *{move.value}* ({move_stat['play_rate']}%) - "
-                                f"`{move_stat['wins']}W/{move_stat['losses']}L/{move_stat['draws']}D` "
-                                f"(WR: {move_stat['win_rate']}%)"
-                            )
-                    
-                    # Add opponent analysis with special case for Irene
-                    if player2_id == "U05QD315XTP":  # Irene's user ID
-                        lines.extend([
-                            "",
-                            "🤔 *Analyse de l'adversaire*",
-                            "Irène est imprévisible, elle joue en 4D chess...",
-                            "Même ChatGPT ne peut pas prédire ses coups !",
-                            "Bonne chance ! 🎲"
-                        ])
-                    else:
-                        # Add strategy analysis
-                        lines.append("\n🎯 *Analyse stratégique*")
-                        
-                        if 'opponent_favorite' in stats and stats['opponent_favorite']:
-                            opp_move = Gesture(stats['opponent_favorite'])
-                            lines.append(f"• {player2_name} joue souvent {opp_move.emoji} *{opp_move.value}*")
-                        
-                        if 'best_opener' in stats and stats['best_opener']:
-                            opener = Gesture(stats['best_opener'])
-                            lines.append(f"• Meilleur coup d'ouverture: {opener.emoji} *{opener.value}*")
-                        
-                        if 'best_counter' in stats and stats['best_counter']:
-                            counter = Gesture(stats['best_counter'])
-                            lines.append(f"• Meilleur contre: {counter.emoji} *{counter.value}*")
-                    
-                    text = "\n".join(lines)
-            
-            elif len(mentions) == 1:
-                # Single player stats
-                target_user_id = mentions[0][2:-1].split('|')[0]
-                logger.info(f"Computing stats for specific user: {target_user_id}")
-                user_name = get_nickname(target_user_id) or f"<@{target_user_id}>"
-                logger.info(f"User nickname resolved to: {user_name}")
+                # Create text output
+                lines = [
+                    f"🤼 *Stats de {player1_name} contre {player2_name}* 🤼\n",
+                    f"Total: `{stats['total_games']}` parties"
+                ]
                 
                 if show_breakdown:
-                    stats = get_move_stats_breakdown(target_user_id)
-                else:
-                    stats = get_player_stats(target_user_id)
-            else:
-                # Global stats
-                logger.info("Computing global stats for all users")
-                if show_breakdown:
-                    stats = get_move_stats_breakdown()
-                else:
-                    stats = get_move_stats()
-            
-            if not stats and len(mentions) <= 1:
-                text = f"{'Ce joueur' if mentions else 'Personne'} n'a pas encore joué cette année ! 😢"
-                logger.info(f"No stats found: {text}")
-            elif len(mentions) <= 1 and stats:
-                if show_breakdown:
-                    logger.info("Formatting breakdown stats")
-                    lines = [f"📊 *Statistiques détaillées des coups{' de ' + user_name if len(mentions) == 1 else ''}* 📊\n"]
-                    
-                    for move_name in ['ROCK', 'PAPER', 'SCISSORS']:
-                        move = Gesture(move_name)
-                        move_stats = stats[move_name]
+                    # Add detailed breakdown stats for each move
+                    for move_name in stats['moves']:
+                        move = GESTURE_BY_VALUE[move_name]
+                        move_stats = stats['moves'][move_name]
                         
-                        lines.append(f"{move.emoji} *{move.value}*")
+                        lines.append(f"\n{move.emoji} *{move.value}*")
                         
                         if move_stats['first']:
                             first = move_stats['first']
@@ -207,51 +85,150 @@ class handler(BaseHTTPRequestHandler):
                                 f"`{second['wins']}W/{second['losses']}L/{second['draws']}D` "
                                 f"(WR: {second['win_rate']}% sur {second['total_games']} parties)"
                             )
-                        
-                        lines.append("")  # Add spacing between moves
                 else:
-                    logger.info("Formatting regular stats")
-                    lines = [f"📊 *Statistiques des coups joués{' par ' + user_name if len(mentions) == 1 else ''}* 📊\n"]
-                    
-                    for move_stat in stats:
-                        move = Gesture(move_stat['move'])
-                        logger.info(f"Processing stats for {move.value}: "
-                                  f"W/L/D: {move_stat['wins']}/{move_stat['losses']}/{move_stat['draws']} "
-                                  f"(Win rate: {move_stat['win_rate']}%, Play rate: {move_stat['play_rate']}%)")
+                    # Add regular stats for each move
+                    for move_stat in stats['moves']:
+                        move = GESTURE_BY_VALUE[move_stat['move']]
+                        logger.debug('Processing stats for %s: W/L/D: %s/%s/%s',
+                                     move.value, move_stat['wins'], move_stat['losses'], move_stat['draws'])
                         
                         lines.append(
-                            f"{move.emoji} *{move.value}* ({move_stat['play_rate']}% des coups) - "
+                            f"{move.emoji} *{move.value}* ({move_stat['play_rate']}%) - "
                             f"`{move_stat['wins']}W/{move_stat['losses']}L/{move_stat['draws']}D` "
                             f"(WR: {move_stat['win_rate']}%)"
                         )
                 
+                # Add opponent analysis with special case for Irene
+                if player2_id == "U05QD315XTP":  # Irene's user ID
+                    lines.extend([
+                        "",
+                        "🤔 *Analyse de l'adversaire*",
+                        "Irène est imprévisible, elle joue en 4D chess...",
+                        "Même ChatGPT ne peut pas prédire ses coups !",
+                        "Bonne chance ! 🎲"
+                    ])
+                else:
+                    # Add strategy analysis
+                    lines.append("\n🎯 *Analyse stratégique*")
+                    
+                    if 'opponent_favorite' in stats and stats['opponent_favorite']:
+                        opp_move = GESTURE_BY_VALUE[stats['opponent_favorite']]
+                        lines.append(f"• {player2_name} joue souvent {opp_move.emoji} *{opp_move.value}*")
+                    
+                    if 'best_opener' in stats and stats['best_opener']:
+                        opener = GESTURE_BY_VALUE[stats['best_opener']]
+                        lines.append(f"• Meilleur coup d'ouverture: {opener.emoji} *{opener.value}*")
+                    
+                    if 'best_counter' in stats and stats['best_counter']:
+                        counter = GESTURE_BY_VALUE[stats['best_counter']]
+                        lines.append(f"• Meilleur contre: {counter.emoji} *{counter.value}*")
+                
                 text = "\n".join(lines)
+        
+        elif len(mentions) == 1:
+            # Single player stats
+            target_user_id = mentions[0]
+            logger.debug('Computing stats for specific user: %s', target_user_id)
+            user_name = get_nickname(target_user_id) or f"<@{target_user_id}>"
+            logger.debug('User nickname resolved to: %s', user_name)
+            
+            if show_breakdown:
+                stats = get_move_stats_breakdown(target_user_id)
+            else:
+                stats = get_player_stats(target_user_id)
+        else:
+            # Global stats
+            logger.info("Computing global stats for all users")
+            if show_breakdown:
+                stats = get_move_stats_breakdown()
+            else:
+                stats = get_move_stats()
+        
+        if not stats and len(mentions) <= 1:
+            text = f"{'Ce joueur' if mentions else 'Personne'} n'a pas encore joué cette année ! 😢"
+            logger.info('No stats found: %s', text)
+        elif len(mentions) <= 1 and stats:
+            if show_breakdown:
+                logger.info("Formatting breakdown stats")
+                lines = [f"📊 *Statistiques détaillées des coups{' de ' + user_name if len(mentions) == 1 else ''}* 📊\n"]
+                
+                for move_name in ['ROCK', 'PAPER', 'SCISSORS']:
+                    move = GESTURE_BY_VALUE[move_name]
+                    move_stats = stats[move_name]
+                    
+                    lines.append(f"{move.emoji} *{move.value}*")
+                    
+                    if move_stats['first']:
+                        first = move_stats['first']
+                        lines.append(
+                            f"• En premier: "
+                            f"`{first['wins']}W/{first['losses']}L/{first['draws']}D` "
+                            f"(WR: {first['win_rate']}% sur {first['total_games']} parties)"
+                        )
+                    
+                    if move_stats['second']:
+                        second = move_stats['second']
+                        lines.append(
+                            f"• En second: "
+                            f"`{second['wins']}W/{second['losses']}L/{second['draws']}D` "
+                            f"(WR: {second['win_rate']}% sur {second['total_games']} parties)"
+                        )
+                    
+                    lines.append("")  # Add spacing between moves
+            else:
+                logger.info("Formatting regular stats")
+                lines = [f"📊 *Statistiques des coups joués{' par ' + user_name if len(mentions) == 1 else ''}* 📊\n"]
+                
+                for move_stat in stats:
+                    move = GESTURE_BY_VALUE[move_stat['move']]
+                    logger.debug('Processing stats for %s: W/L/D: %s/%s/%s (Win rate: %s%%, Play rate: %s%%)',
+                                 move.value, move_stat['wins'], move_stat['losses'], move_stat['draws'],
+                                 move_stat['win_rate'], move_stat['play_rate'])
+                    
+                    lines.append(
+                        f"{move.emoji} *{move.value}* ({move_stat['play_rate']}% des coups) - "
+                        f"`{move_stat['wins']}W/{move_stat['losses']}L/{move_stat['draws']}D` "
+                        f"(WR: {move_stat['win_rate']}%)"
+                    )
+            
+            text = "\n".join(lines)
 
-            response_message = {
-                'response_type': 'in_channel',
-                'text': text
-            }
+        response_message = {
+            'response_type': 'in_channel',
+            'text': text
+        }
+
+        # Send response
+        logger.info('Sending response to Slack')
+        post_response(response_url, response_message, command.channel_id)
+        logger.info('Request completed successfully')
+
+    except Exception as e:
+        logger.error('Error processing request: %s', e, exc_info=True)
+        error_response = {
+            'response_type': 'ephemeral',
+            'text': f"Une erreur s'est produite: {str(e)}"
+        }
+        try:
+            post_response(response_url, error_response)
+        except Exception:
+            logger.exception('Error posting the error message to Slack')
 
-            # Send response
-            logger.info(f"Sending response to Slack")
-            requests.post(slack_params['response_url'], json=response_message)
 
-            # Send immediate empty 200 response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'')
-            logger.info('Request completed successfully')
+class handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # Read the body, verifying the request is from Slack in production
+        post_data = read_slack_body(self)
+        if post_data is None:
+            return
+
+        # Parse form data
+        command = parse_slash_command(post_data)
 
-        except Exception as e:
-            logger.error(f'Error processing request: {str(e)}', exc_info=True)
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            error_response = {
-                'response_type': 'ephemeral',
-                'text': f"Une erreur s'est produite: {str(e)}"
-            }
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+        logger.info('Received stats request from user %s', command.user_id)
 
-        return 
\ No newline at end of file
+        # Acknowledge right away, Slack only waits 3 seconds for slash commands.
+        # Stats are computed and sent after the request has been acknowledged
+        write_response(self, 200)
+        executor.submit(send_stats, command)
+        return
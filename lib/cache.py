@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get on a miss, so that None can be cached as a value
+MISSING = object()
+
+
+class TTLCache:
+    """A small thread-safe LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """Get a cached value, or `default` if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entry if the cache is full"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_set(self, key, producer):
+        """Get a cached value, computing and storing it with `producer()` on a miss"""
+        value = self.get(key)
+        if value is MISSING:
+            value = producer()
+            self.set(key, value)
+        return value
+
+    def pop(self, key):
+        """Drop a single entry if it exists"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+
+
+# Formatted Slack responses shared by the slash commands, keyed by endpoint (and argument).
+# Each instance has its own cache: it is cleared when this instance writes a game or a nickname,
+# but writes from other instances only show up once the entries expire, after at most `ttl` seconds.
+response_cache = TTLCache(maxsize=256, ttl=30)
@@ -1,169 +1,356 @@
 import os
-import psycopg2
-
-
+import threading
+import time
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager
+
+from psycopg2 import Binary, InterfaceError, OperationalError
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+from lib.cache import MISSING, TTLCache, response_cache
+
+# Connections are kept open between requests handled by the same process.
+# Serverless instances each hold their own pool, DATABASE_POOL_SIZE keeps the total under the server limit
+_POOL_MAX_SIZE = int(os.getenv('DATABASE_POOL_SIZE', '4'))
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when exhausted, this makes borrowers wait instead.
+# Waits are bounded so a stuck database fails requests instead of piling them up
+_pool_slots = threading.BoundedSemaphore(_POOL_MAX_SIZE)
+_POOL_TIMEOUT = 5
+# The server or PgBouncer may drop idle connections without the client noticing, connections
+# idle for longer than this are checked before use. Keyed by connection, when it went back to the pool
+_IDLE_CHECK_AFTER = 30
+_returned_at = weakref.WeakKeyDictionary()
+
+# Nicknames rarely change, keep them around for a few minutes per process
+_nickname_cache = TTLCache(maxsize=2048, ttl=300)
+
+# Rows of the game lookups. target_id is only set on challenges, player2_id is also set once a game is complete
+Game = namedtuple('Game', 'id player1_id player1_move player2_id status')
+CompletedGame = namedtuple('CompletedGame', 'id player1_id player1_move target_id player1_nickname player2_nickname')
+
+# Set once the tables have been created by this process.
+# Workers run concurrently, the lock keeps them from creating the tables at the same time
+_tables_initialized = False
+_tables_lock = threading.Lock()
+
+
+def _get_pool():
+    """Create the process-wide connection pool on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(1, _POOL_MAX_SIZE, os.getenv('DATABASE_URL'))
+    return _pool
+
+
+def _checkout(pool):
+    """Get a connection from the pool in autocommit mode.
+    Connections that were dropped while idle are discarded, and a fresh one is taken once"""
+    conn = pool.getconn()
+    returned_at = _returned_at.pop(conn, None)
+    try:
+        conn.autocommit = True
+        if returned_at is not None and time.monotonic() - returned_at > _IDLE_CHECK_AFTER:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+    except (OperationalError, InterfaceError):
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+        conn.autocommit = True
+    return conn
+
+
+@contextmanager
 def get_db_connection():
-    """Get a PostgreSQL database connection"""
-    return psycopg2.connect(os.getenv('DATABASE_URL'))
+    """Borrow a PostgreSQL connection from the pool, in autocommit mode.
+    The connection goes back to the pool when the block exits.
+    Raises PoolError if no connection frees up within _POOL_TIMEOUT seconds"""
+    if not _pool_slots.acquire(timeout=_POOL_TIMEOUT):
+        raise PoolError('no database connection available')
+    try:
+        pool = _get_pool()
+        conn = _checkout(pool)
+        try:
+            yield conn
+        finally:
+            if not conn.closed:
+                _returned_at[conn] = time.monotonic()
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
 
 
 def init_tables():
-    """Create the games and nicknames tables if they don't exist"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS nicknames (
-            user_id TEXT PRIMARY KEY,
-            nickname TEXT NOT NULL,
-            user_name TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS games (
-            id SERIAL PRIMARY KEY,
-            channel_id TEXT NOT NULL,
-            channel_name TEXT NOT NULL,
-            player1_id TEXT NOT NULL,
-            player1_name TEXT NOT NULL,
-            player1_move TEXT NOT NULL,
-            player2_id TEXT,
-            player2_name TEXT,
-            player2_move TEXT,
-            status TEXT NOT NULL DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-def get_pending_game(channel_id):
-    """Get the most recent unfinished game in a channel (non-challenge only)"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, player1_id, player1_move, player2_id, player2_move 
-        FROM games 
-        WHERE channel_id = %s 
-        AND player2_id IS NULL 
-        AND status = 'pending'
-        ORDER BY created_at DESC 
-        LIMIT 1
-    ''', (channel_id,))
-    game = cur.fetchone()
-    cur.close()
-    conn.close()
-    return game
+    """Create the games and nicknames tables if they don't exist.
+    Only hits the database on the first call of each process"""
+    global _tables_initialized
+    if _tables_initialized:
+        return
+
+    with _tables_lock:
+        if _tables_initialized:
+            return
+
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS nicknames (
+                    user_id TEXT PRIMARY KEY,
+                    nickname TEXT NOT NULL,
+                    user_name TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS games (
+                    id SERIAL PRIMARY KEY,
+                    channel_id TEXT NOT NULL,
+                    channel_name TEXT NOT NULL,
+                    player1_id TEXT NOT NULL,
+                    player1_name TEXT NOT NULL,
+                    player1_move TEXT NOT NULL,
+                    player2_id TEXT,
+                    player2_name TEXT,
+                    player2_move TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Pending games are looked up by channel and by pair of players, keep those lookups
+            # on small partial indexes. Nicknames are looked up by their primary key
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS games_pending_channel_idx
+                ON games (channel_id, created_at DESC)
+                WHERE status = 'pending' AND player2_id IS NULL
+            ''')
+
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS games_pending_players_idx
+                ON games (player1_id, player2_id)
+                WHERE status = 'pending'
+            ''')
+
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS leaderboard_cache (
+                    key TEXT PRIMARY KEY,
+                    body BYTEA NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Tables created before precomputed leaderboards were versioned
+            cur.execute('ALTER TABLE leaderboard_cache ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0')
+        _tables_initialized = True
 
 
 def create_game(channel_id, channel_name, player_id, player_name, move, opponent_id=None, opponent_name=None):
     """Create a new game with the first player's move and optional opponent"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO games (channel_id, channel_name, player1_id, player1_name, player1_move, player2_id, player2_name)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    ''', (channel_id, channel_name, player_id, player_name, move, opponent_id, opponent_name))
-    game_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO games (channel_id, channel_name, player1_id, player1_name, player1_move, player2_id, player2_name)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (channel_id, channel_name, player_id, player_name, move, opponent_id, opponent_name))
+        game_id = cur.fetchone()[0]
+    # A new game shows up in the pending challenges
+    response_cache.clear()
     return game_id
 
 
-def update_game(game_id, player2_id, player2_name, move):
-    """Update a game with the second player's move"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        UPDATE games 
-        SET player2_id = %s, player2_name = %s, player2_move = %s, status = 'complete'
-        WHERE id = %s
-    ''', (player2_id, player2_name, move, game_id))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-def get_pending_challenge(challenger_id, opponent_id):
-    """Get a pending challenge between two specific players"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, player1_id, player1_move
-        FROM games 
-        WHERE (
-            (player1_id = %s AND player2_id = %s) OR
-            (player1_id = %s AND player2_id = %s)
-        )
-        AND player2_move IS NULL
-        AND status = 'pending'
-        ORDER BY created_at DESC 
-        LIMIT 1
-    ''', (challenger_id, opponent_id, opponent_id, challenger_id))
-    game = cur.fetchone()
-    cur.close()
-    conn.close()
-    return game
+def create_challenge(channel_id, channel_name, player_id, player_name, move, opponent_id):
+    """Create a challenge game against opponent_id, unless the two players already have one pending.
+    Returns the game ID or None if a challenge exists"""
+    # Concurrent inserts cannot see each other's rows, so the check alone would let two challenges
+    # through. The pair is locked for the transaction, the second insert then sees the first one
+    pair = ':'.join(sorted((player_id, opponent_id)))
+    with get_db_connection() as conn:
+        conn.autocommit = False
+        with conn, conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (pair,))
+            cur.execute('''
+                INSERT INTO games (channel_id, channel_name, player1_id, player1_name, player1_move, player2_id)
+                SELECT %s, %s, %s, %s, %s, %s
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM games
+                    WHERE (
+                        (player1_id = %s AND player2_id = %s) OR
+                        (player1_id = %s AND player2_id = %s)
+                    )
+                    AND player2_move IS NULL
+                    AND status = 'pending'
+                )
+                RETURNING id
+            ''', (channel_id, channel_name, player_id, player_name, move, opponent_id,
+                  player_id, opponent_id, opponent_id, player_id))
+            row = cur.fetchone()
+    if row is None:
+        return None
+    # A new game shows up in the pending challenges
+    response_cache.clear()
+    return row[0]
+
+
+def complete_game(game_id, player2_id, player2_name, move):
+    """Play the second move of a pending game in a single round trip.
+    The game is only claimed if player2 did not create it and, for challenges, is the challenged player,
+    so concurrent or retried clicks cannot complete it twice.
+    Returns a CompletedGame, None if the game could not be completed"""
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            WITH game AS (
+                SELECT id, player1_id, player1_move, player2_id
+                FROM games
+                WHERE id = %s
+                AND status = 'pending'
+            ),
+            completed AS (
+                UPDATE games g
+                SET player2_id = %s, player2_name = %s, player2_move = %s, status = 'complete'
+                FROM game
+                WHERE g.id = game.id
+                AND g.status = 'pending'
+                AND game.player1_id <> %s
+                AND (game.player2_id IS NULL OR game.player2_id = %s)
+                RETURNING game.id, game.player1_id, game.player1_move, game.player2_id
+            ),
+            -- The precomputed leaderboard is outdated once the game is complete
+            purge AS (
+                UPDATE leaderboard_cache
+                SET version = version + 1, updated_at = NULL
+                WHERE EXISTS (SELECT 1 FROM completed)
+            )
+            SELECT c.id, c.player1_id, c.player1_move, c.player2_id, n1.nickname, n2.nickname
+            FROM completed c
+            LEFT JOIN nicknames n1 ON n1.user_id = c.player1_id
+            LEFT JOIN nicknames n2 ON n2.user_id = %s
+        ''', (game_id, player2_id, player2_name, move, player2_id, player2_id, player2_id))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    # Completed games change the standings and the pending challenges
+    response_cache.clear()
+    return CompletedGame._make(row)
 
 
 def get_nickname(user_id):
     """Get a user's nickname if it exists"""
+    nickname = _nickname_cache.get(user_id)
+    if nickname is not MISSING:
+        return nickname
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT nickname FROM nicknames WHERE user_id = %s', (user_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT nickname FROM nicknames WHERE user_id = %s', (user_id,))
+        result = cur.fetchone()
 
     # Update cache and return
     nickname = result[0] if result else None
+    _nickname_cache.set(user_id, nickname)
     return nickname
 
 
+def get_nicknames(user_ids):
+    """Get the nicknames of several users in a single query.
+    Returns a dict mapping user_id to nickname, users without a nickname are left out"""
+    nicknames = {}
+    missing_ids = []
+    for user_id in {user_id for user_id in user_ids if user_id}:
+        nickname = _nickname_cache.get(user_id)
+        if nickname is MISSING:
+            missing_ids.append(user_id)
+        elif nickname is not None:
+            nicknames[user_id] = nickname
+
+    if missing_ids:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT user_id, nickname FROM nicknames WHERE user_id = ANY(%s)', (missing_ids,))
+            results = dict(cur.fetchall())
+
+        # Cache users without a nickname too so they don't hit the database again
+        for user_id in missing_ids:
+            _nickname_cache.set(user_id, results.get(user_id))
+        nicknames.update(results)
+
+    return nicknames
+
+
 def set_nickname(user_id, nickname, user_name):
     """Set or update a user's nickname and username"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO nicknames (user_id, nickname, user_name)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (user_id) 
-        DO UPDATE SET 
-            nickname = EXCLUDED.nickname,
-            user_name = EXCLUDED.user_name,
-            updated_at = CURRENT_TIMESTAMP
-    ''', (user_id, nickname, user_name))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO nicknames (user_id, nickname, user_name)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) 
+            DO UPDATE SET 
+                nickname = EXCLUDED.nickname,
+                user_name = EXCLUDED.user_name,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (user_id, nickname, user_name))
+        cur.execute('UPDATE leaderboard_cache SET version = version + 1, updated_at = NULL')
+    _nickname_cache.set(user_id, nickname)
+    # Nicknames are displayed in every cached response
+    response_cache.clear()
+
+
+def get_cached_leaderboard(key, max_age):
+    """Get a precomputed leaderboard message and its version, as a (body, version) tuple.
+    The body is None unless it was stored less than max_age seconds ago, the version is None if it was never stored.
+    Writes to games and nicknames purge the message by bumping its version, see set_cached_leaderboard"""
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT
+                CASE WHEN updated_at > CURRENT_TIMESTAMP - make_interval(secs => %s) THEN body END,
+                version
+            FROM leaderboard_cache
+            WHERE key = %s
+        ''', (max_age, key))
+        result = cur.fetchone()
+    if result is None:
+        return None, None
+    body, version = result
+    return (bytes(body) if body is not None else None), version
+
+
+def set_cached_leaderboard(key, body, version):
+    """Store a precomputed leaderboard message, shared by every instance.
+    version is the one read before building the message, the message is dropped if it was purged since,
+    so a build that raced with a write cannot store outdated standings.
+    Stored rows are only ever purged, not deleted, so only the very first build of a key is not checked"""
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO leaderboard_cache (key, body)
+            VALUES (%s, %s)
+            ON CONFLICT (key)
+            DO UPDATE SET
+                body = EXCLUDED.body,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE leaderboard_cache.version = %s
+        ''', (key, Binary(body), version))
 
 
 def get_pending_challenges():
     """Get all pending challenges"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT 
-            channel_id,
-            player1_id,
-            player2_id,
-            created_at
-        FROM games 
-        WHERE status = 'pending'
-        AND player2_id IS NOT NULL
-        AND player2_move IS NULL
-        ORDER BY created_at DESC
-    ''')
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT 
+                channel_id,
+                player1_id,
+                player2_id,
+                created_at
+            FROM games 
+            WHERE status = 'pending'
+            AND player2_id IS NOT NULL
+            AND player2_move IS NULL
+            ORDER BY created_at DESC
+        ''')
+        results = cur.fetchall()
     return [
         {
             'channel_id': row[0],
@@ -177,142 +364,148 @@ def get_pending_challenges():
 
 def get_user_stats(user_id):
     """Get detailed stats for a specific user"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with get_db_connection() as conn, conn.cursor() as cur:
 
-    # Get overall stats
-    cur.execute('''
-        WITH game_results AS (
-            -- First player wins
-            SELECT 
-                player1_id as winner_id,
-                player1_name as winner_name,
-                player2_id as loser_id,
-                player2_name as loser_name,
-                created_at,
-                'WIN' as result
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND (
-                    (player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                    (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                    (player1_move = 'SCISSORS' AND player2_move = 'PAPER')
-                )
-            UNION ALL
-            -- Second player wins
-            SELECT 
-                player2_id as winner_id,
-                player2_name as winner_name,
-                player1_id as loser_id,
-                player1_name as loser_name,
-                created_at,
-                'WIN' as result
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND (
-                    (player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
-                    (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
-                    (player2_move = 'SCISSORS' AND player1_move = 'PAPER')
-                )
-            UNION ALL
-             -- Draws as player 1
-            SELECT
-                player1_id as winner_id,
-                player1_name as winner_name,
-                player2_id as loser_id,
-                player2_name as loser_name,
-                created_at,
-                'DRAW' as result
-            FROM games
-            WHERE status = 'complete'
-                AND player1_id = %s
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_move = player2_move
-            UNION ALL
-            -- Draws as player 2
-            SELECT
-                player2_id as winner_id,
-                player2_name as winner_name,
-                player1_id as loser_id,
-                player1_name as loser_name,
-                created_at,
-                'DRAW' as result
-            FROM games
-            WHERE status = 'complete'
-                AND player2_id = %s
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_move = player2_move
-        ),
-        nemesis AS (
-            SELECT 
-                winner_id as opponent_id,
-                winner_name as opponent_name,
-                COUNT(*) as wins
-            FROM game_results
-            WHERE loser_id = %s
-            AND result = 'WIN'
-            GROUP BY winner_id, winner_name
-            ORDER BY wins DESC
-            LIMIT 1
-        ),
-        best_against AS (
-            SELECT 
-                loser_id as opponent_id,
-                loser_name as opponent_name,
-                COUNT(*) as wins
-            FROM game_results
-            WHERE winner_id = %s
-            AND result = 'WIN'
-            GROUP BY loser_id, loser_name
-            ORDER BY wins DESC
-            LIMIT 1
-        ),
-        most_draws AS (
-            SELECT loser_id as opponent_id, loser_name as opponent_name,
-                count(*) as draws
-            FROM game_results
-            WHERE result = 'DRAW'
-            GROUP BY loser_id, loser_name
-            ORDER BY draws DESC
-            LIMIT 1
-        ),
-        user_stats AS (
+        # Get overall stats
+        cur.execute('''
+            WITH game_results AS (
+                -- First player wins
+                SELECT 
+                    player1_id as winner_id,
+                    player1_name as winner_name,
+                    player2_id as loser_id,
+                    player2_name as loser_name,
+                    created_at,
+                    'WIN' as result
+                FROM games 
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND (
+                        (player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
+                        (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
+                        (player1_move = 'SCISSORS' AND player2_move = 'PAPER')
+                    )
+                UNION ALL
+                -- Second player wins
+                SELECT 
+                    player2_id as winner_id,
+                    player2_name as winner_name,
+                    player1_id as loser_id,
+                    player1_name as loser_name,
+                    created_at,
+                    'WIN' as result
+                FROM games
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND (
+                        (player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
+                        (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
+                        (player2_move = 'SCISSORS' AND player1_move = 'PAPER')
+                    )
+                UNION ALL
+                 -- Draws as player 1
+                SELECT
+                    player1_id as winner_id,
+                    player1_name as winner_name,
+                    player2_id as loser_id,
+                    player2_name as loser_name,
+                    created_at,
+                    'DRAW' as result
+                FROM games
+                WHERE status = 'complete'
+                    AND player1_id = %s
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND player1_move = player2_move
+                UNION ALL
+                -- Draws as player 2
+                SELECT
+                    player2_id as winner_id,
+                    player2_name as winner_name,
+                    player1_id as loser_id,
+                    player1_name as loser_name,
+                    created_at,
+                    'DRAW' as result
+                FROM games
+                WHERE status = 'complete'
+                    AND player2_id = %s
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND player1_move = player2_move
+            ),
+            nemesis AS (
+                SELECT 
+                    winner_id as opponent_id,
+                    winner_name as opponent_name,
+                    COUNT(*) as wins
+                FROM game_results
+                WHERE loser_id = %s
+                AND result = 'WIN'
+                GROUP BY winner_id, winner_name
+                ORDER BY wins DESC
+                LIMIT 1
+            ),
+            best_against AS (
+                SELECT 
+                    loser_id as opponent_id,
+                    loser_name as opponent_name,
+                    COUNT(*) as wins
+                FROM game_results
+                WHERE winner_id = %s
+                AND result = 'WIN'
+                GROUP BY loser_id, loser_name
+                ORDER BY wins DESC
+                LIMIT 1
+            ),
+            most_draws AS (
+                SELECT loser_id as opponent_id, loser_name as opponent_name,
+                    count(*) as draws
+                FROM game_results
+                WHERE result = 'DRAW'
+                GROUP BY loser_id, loser_name
+                ORDER BY draws DESC
+                LIMIT 1
+            ),
+            user_stats AS (
+                SELECT 
+                    COUNT(CASE WHEN winner_id = %s AND result = 'WIN' THEN 1 END) as wins,
+                    COUNT(CASE WHEN loser_id = %s  AND result = 'WIN' THEN 1 END) as losses,
+                    COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws
+                FROM game_results
+                WHERE winner_id = %s OR loser_id = %s
+            )
             SELECT 
-                COUNT(CASE WHEN winner_id = %s AND result = 'WIN' THEN 1 END) as wins,
-                COUNT(CASE WHEN loser_id = %s  AND result = 'WIN' THEN 1 END) as losses,
-                COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws
-            FROM game_results
-            WHERE winner_id = %s OR loser_id = %s
-        )
-        SELECT 
-            s.wins, s.losses, s.draws,
-            n.opponent_id as nemesis_id,
-            n.opponent_name as nemesis_name,
-            n.wins as nemesis_wins,
-            b.opponent_id as best_against_id,
-            b.opponent_name as best_against_name,
-            b.wins as best_against_wins,
-            md.opponent_id as most_draws_id, md.opponent_name as most_draws_name,
-            md.draws as most_draws_count
-        FROM user_stats s
-        LEFT JOIN nemesis n ON true
-        LEFT JOIN best_against b ON true
-        LEFT JOIN most_draws md ON true
-    ''', (user_id, user_id, user_id, user_id, user_id, user_id, user_id, user_id))
-
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+                s.wins, s.losses, s.draws,
+                n.opponent_id as nemesis_id,
+                n.opponent_name as nemesis_name,
+                n.wins as nemesis_wins,
+                nn.nickname as nemesis_nickname,
+                b.opponent_id as best_against_id,
+                b.opponent_name as best_against_name,
+                b.wins as best_against_wins,
+                bn.nickname as best_against_nickname,
+                md.opponent_id as most_draws_id, md.opponent_name as most_draws_name,
+                md.draws as most_draws_count,
+                mdn.nickname as most_draws_nickname,
+                un.nickname as user_nickname
+            FROM user_stats s
+            LEFT JOIN nemesis n ON true
+            LEFT JOIN best_against b ON true
+            LEFT JOIN most_draws md ON true
+            LEFT JOIN nicknames nn ON nn.user_id = n.opponent_id
+            LEFT JOIN nicknames bn ON bn.user_id = b.opponent_id
+            LEFT JOIN nicknames mdn ON mdn.user_id = md.opponent_id
+            LEFT JOIN nicknames un ON un.user_id = %s
+        ''', (user_id, user_id, user_id, user_id, user_id, user_id, user_id, user_id, user_id))
+
+        result = cur.fetchone()
 
     if not result:
         return None
 
     wins, losses, draws = result[0:3]
-    nemesis_id, nemesis_name, nemesis_wins = result[3:6]
-    best_against_id, best_again_name, best_against_wins = result[6:9]
-    most_draws_id, most_draws_name, most_draws_wins = result[9:12]
+    nemesis_id, nemesis_name, nemesis_wins, nemesis_nickname = result[3:7]
+    best_against_id, best_again_name, best_against_wins, best_against_nickname = result[7:11]
+    most_draws_id, most_draws_name, most_draws_wins, most_draws_nickname = result[11:15]
+    user_nickname = result[15]
     total_games = wins + losses + draws
 
     win_rate = round(wins / total_games * 100, 1) if total_games > 0 else 0
@@ -323,241 +516,203 @@ def get_user_stats(user_id):
         'draws': draws,
         'total_games': total_games,
         'win_rate': win_rate,
+        'nickname': user_nickname,
         'nemesis': {
             'user_id': nemesis_id,
             'user_name': nemesis_name,
+            'nickname': nemesis_nickname,
             'wins': nemesis_wins
         } if nemesis_id else None,
         'best_against': {
             'user_id': best_against_id,
             'user_name': best_again_name,
+            'nickname': best_against_nickname,
             'wins': best_against_wins
         } if best_against_id else None,
         'most_draws': {
             'user_id': most_draws_id,
             'user_name': most_draws_name,
+            'nickname': most_draws_nickname,
             'draws': most_draws_wins
         }
     }
 
 
-def get_unranked_players():
-    """Get players who haven't played enough games to be ranked"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_all_player_stats():
+    """Get the stats of every player for the current year in a single query.
+    Returns a (ranked, unranked) tuple, players need 5 games to be ranked"""
+    with get_db_connection() as conn, conn.cursor() as cur:
 
-    cur.execute('''
-        WITH game_results AS (
-            -- First player participation
-            SELECT 
-                player1_id as player_id,
-                player1_name as player_name
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-            UNION ALL
-            -- Second player participation
-            SELECT 
-                player2_id as player_id,
-                player2_name as player_name
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player2_id IS NOT NULL
-        )
-        SELECT 
-            player_id,
-            MAX(player_name) as player_name,
-            COUNT(*) as games_played,
-            5 - COUNT(*) as games_needed
-        FROM game_results
-        GROUP BY player_id
-        HAVING COUNT(*) < 5
-        ORDER BY COUNT(*) DESC, MAX(player_name)
-    ''')
-
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    return [
-        {
-            'player_id': row[0],
-            'player_name': row[1],
-            'games_played': row[2],
-            'games_needed': row[3]
-        }
-        for row in results
-    ]
-
-
-def get_leaderboard():
-    """Get the leaderboard for the current year"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute('''
-        WITH game_results AS (
-            -- First player wins
-            SELECT 
-                player1_id as winner_id,
-                player2_id as loser_id,
-                player1_name as winner_name,
-                player2_name as loser_name,
-                'WIN' as result
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND (
-                    (player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                    (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                    (player1_move = 'SCISSORS' AND player2_move = 'PAPER')
-                )
-            UNION ALL
-            -- Second player wins
-            SELECT 
-                player2_id as winner_id,
-                player1_id as loser_id,
-                player2_name as winner_name,
-                player1_name as loser_name,
-                'WIN' as result
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND (
-                    (player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
-                    (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
-                    (player2_move = 'SCISSORS' AND player1_move = 'PAPER')
-                )
-            UNION ALL
-            -- Draws (each player gets counted once)
-            SELECT 
-                player1_id as winner_id,
-                player2_id as loser_id,
-                player1_name as winner_name,
-                player2_name as loser_name,
-                'DRAW' as result
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_move = player2_move
-            UNION ALL
-            SELECT 
-                player2_id as winner_id,
-                player1_id as loser_id,
-                player2_name as winner_name,
-                player1_name as loser_name,
-                'DRAW' as result
-            FROM games 
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_move = player2_move
-        ),
-        player_stats AS (
-            SELECT 
-                p.player_id,
-                p.player_name,
-                p.wins,
-                p.losses,
-                p.draws,
-                p.wins + p.losses as total_games,
-                COALESCE(ROUND(CAST(CAST(p.wins AS FLOAT) / (NULLIF(p.wins, 0)+NULLIF(p.losses, 0)) * 100 AS numeric), 1),0) as win_rate
-            FROM (
+        cur.execute('''
+            WITH game_results AS (
+                -- First player wins
                 SELECT 
-                    player_id,
-                    player_name,
-                    COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
-                    COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
-                    COUNT(CASE WHEN result IS NULL THEN 1 END) as losses
+                    player1_id as winner_id,
+                    player2_id as loser_id,
+                    player1_name as winner_name,
+                    player2_name as loser_name,
+                    'WIN' as result
+                FROM games 
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND (
+                        (player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
+                        (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
+                        (player1_move = 'SCISSORS' AND player2_move = 'PAPER')
+                    )
+                UNION ALL
+                -- Second player wins
+                SELECT 
+                    player2_id as winner_id,
+                    player1_id as loser_id,
+                    player2_name as winner_name,
+                    player1_name as loser_name,
+                    'WIN' as result
+                FROM games 
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND (
+                        (player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
+                        (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
+                        (player2_move = 'SCISSORS' AND player1_move = 'PAPER')
+                    )
+                UNION ALL
+                -- Draws (each player gets counted once)
+                SELECT 
+                    player1_id as winner_id,
+                    player2_id as loser_id,
+                    player1_name as winner_name,
+                    player2_name as loser_name,
+                    'DRAW' as result
+                FROM games 
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND player1_move = player2_move
+                UNION ALL
+                SELECT 
+                    player2_id as winner_id,
+                    player1_id as loser_id,
+                    player2_name as winner_name,
+                    player1_name as loser_name,
+                    'DRAW' as result
+                FROM games 
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND player1_move = player2_move
+            ),
+            player_stats AS (
+                SELECT 
+                    p.*,
+                    COALESCE(ROUND(CAST(CAST(p.wins AS FLOAT) / (NULLIF(p.wins, 0)+NULLIF(p.losses, 0)) * 100 AS numeric), 1),0) as win_rate,
+                    p.games_played >= 5 as ranked
                 FROM (
-                    SELECT winner_id as player_id, winner_name as player_name, result FROM game_results
-                    UNION ALL
-                    SELECT loser_id as player_id, loser_name as player_name, NULL as result FROM game_results WHERE result = 'WIN'
-                ) all_results
-                GROUP BY player_id, player_name
-            ) p
-            WHERE p.wins + p.losses + p.draws >= 5
-        )
-        SELECT 
-            player_id,
-            player_name as user_name,
-            wins,
-            losses,
-            draws,
-            win_rate
-        FROM player_stats
-        ORDER BY win_rate DESC, wins DESC, total_games DESC
-    ''')
-
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    return [
-        {
-            'player_id': row[0],
-            'user_name': row[1],
-            'wins': row[2],
-            'losses': row[3],
-            'draws': row[4],
-            'win_rate': row[5]
-        }
-        for row in results
-    ]
+                    SELECT 
+                        player_id,
+                        MAX(player_name) as player_name,
+                        COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
+                        COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
+                        COUNT(CASE WHEN result IS NULL THEN 1 END) as losses,
+                        COUNT(*) as games_played
+                    FROM (
+                        SELECT winner_id as player_id, winner_name as player_name, result FROM game_results
+                        UNION ALL
+                        SELECT loser_id as player_id, loser_name as player_name, NULL as result FROM game_results WHERE result = 'WIN'
+                    ) all_results
+                    GROUP BY player_id
+                ) p
+            )
+            SELECT 
+                ps.player_id,
+                ps.player_name,
+                ps.wins,
+                ps.losses,
+                ps.draws,
+                ps.win_rate,
+                ps.games_played,
+                n.nickname,
+                ps.ranked
+            FROM player_stats ps
+            LEFT JOIN nicknames n ON n.user_id = ps.player_id
+            ORDER BY
+                ps.ranked DESC,
+                -- Ranked players by win rate, unranked ones by games played
+                CASE WHEN ps.ranked THEN ps.win_rate END DESC,
+                CASE WHEN ps.ranked THEN ps.wins END DESC,
+                CASE WHEN ps.ranked THEN ps.wins + ps.losses END DESC,
+                ps.games_played DESC,
+                ps.player_name
+        ''')
+
+        results = cur.fetchall()
+
+    # Both lists come out of the same scan, split them on the ranked flag
+    ranked = []
+    unranked = []
+    for row in results:
+        if row[8]:
+            ranked.append({
+                'player_id': row[0],
+                'user_name': row[1],
+                'wins': row[2],
+                'losses': row[3],
+                'draws': row[4],
+                'win_rate': row[5],
+                'nickname': row[7]
+            })
+        else:
+            unranked.append({
+                'player_id': row[0],
+                'player_name': row[1],
+                'games_played': row[6],
+                'games_needed': 5 - row[6],
+                'nickname': row[7]
+            })
+    return ranked, unranked
 
 
 def get_game_by_id(game_id):
-    """Get a game by its ID.
-    Returns (game_id, player1_id, player1_move, player2_id, player2_move) if found, None otherwise"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, player1_id, player1_move, player2_id, player2_move
-        FROM games 
-        WHERE id = %s
-        AND status = 'pending'
-        LIMIT 1
-    ''', (game_id,))
-    game = cur.fetchone()
-    cur.close()
-    conn.close()
-    return game
+    """Get a game by its ID whatever its status, as a Game if found, None otherwise"""
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT id, player1_id, player1_move, player2_id, status
+            FROM games
+            WHERE id = %s
+        ''', (game_id,))
+        row = cur.fetchone()
+    return Game._make(row) if row else None
 
 
 def get_move_stats():
     """Get statistics about moves played in the current year"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute('''
-        WITH game_results as (
-            SELECT player1_move as move,
-                   CASE
-                       WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                             (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                             (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
-                       WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
-                             (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
-                             (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
-                       ELSE 'DRAW'
-                       END      as result
-            FROM games
-            WHERE status = 'complete'
-              AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-        )
-        SELECT move,
-               COUNT(CASE WHEN result = 'WIN' THEN 1 END)  as wins,
-               COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
-               COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
-               count(*)                                    as total_games
-        FROM game_results
-        GROUP BY move
-        ORDER BY total_games DESC
-    ''')
-
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+
+        cur.execute('''
+            WITH game_results as (
+                SELECT player1_move as move,
+                       CASE
+                           WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
+                                 (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
+                                 (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
+                           WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
+                                 (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
+                                 (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
+                           ELSE 'DRAW'
+                           END      as result
+                FROM games
+                WHERE status = 'complete'
+                  AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+            )
+            SELECT move,
+                   COUNT(CASE WHEN result = 'WIN' THEN 1 END)  as wins,
+                   COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
+                   COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
+                   count(*)                                    as total_games
+            FROM game_results
+            GROUP BY move
+            ORDER BY total_games DESC
+        ''')
+
+        results = cur.fetchall()
 
     total_games = sum(row[4] for row in results)
 
@@ -578,63 +733,60 @@ def get_move_stats():
 def get_player_stats(user_id):
     """Get statistics about moves played in the current year.
      If user_id is provided, only get stats for that specific user."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    query = '''
-        WITH game_results as (
-            -- First player moves
-            SELECT player1_move as move,
-                   CASE
-                       WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                             (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                             (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
-                       WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
-                             (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
-                             (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
-                       ELSE 'DRAW'
-                       END      as result
-            FROM games
-            WHERE status = 'complete'
-              AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-              {}
-            UNION ALL
-            -- Second player moves
-            SELECT player2_move as move,
-                   CASE
-                       WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
-                             (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
-                             (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
-                       WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
-                             (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
-                             (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
-                       ELSE 'DRAW'
-                       END      as result
-            FROM games
-            WHERE status = 'complete'
-              AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-              {}
+    with get_db_connection() as conn, conn.cursor() as cur:
+
+        query = '''
+            WITH game_results as (
+                -- First player moves
+                SELECT player1_move as move,
+                       CASE
+                           WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
+                                 (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
+                                 (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
+                           WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
+                                 (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
+                                 (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
+                           ELSE 'DRAW'
+                           END      as result
+                FROM games
+                WHERE status = 'complete'
+                  AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                  {}
+                UNION ALL
+                -- Second player moves
+                SELECT player2_move as move,
+                       CASE
+                           WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
+                                 (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
+                                 (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
+                           WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
+                                 (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
+                                 (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
+                           ELSE 'DRAW'
+                           END      as result
+                FROM games
+                WHERE status = 'complete'
+                  AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                  {}
+            )
+            SELECT move,
+                   COUNT(CASE WHEN result = 'WIN' THEN 1 END)  as wins,
+                   COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
+                   COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
+                   count(*)                                    as total_games
+            FROM game_results
+            GROUP BY move
+            ORDER BY total_games DESC
+        '''
+
+        query = query.format(
+            'AND player1_id = %s',
+            'AND player2_id = %s'
         )
-        SELECT move,
-               COUNT(CASE WHEN result = 'WIN' THEN 1 END)  as wins,
-               COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
-               COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
-               count(*)                                    as total_games
-        FROM game_results
-        GROUP BY move
-        ORDER BY total_games DESC
-    '''
-
-    query = query.format(
-        'AND player1_id = %s',
-        'AND player2_id = %s'
-    )
-    params = [user_id, user_id]
-
-    cur.execute(query, params)
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
+        params = [user_id, user_id]
+
+        cur.execute(query, params)
+        results = cur.fetchall()
 
     total_games = sum(row[4] for row in results)
 
@@ -654,84 +806,81 @@ def get_player_stats(user_id):
 
 def get_head_to_head_stats(player1_id, player2_id):
     """Get head-to-head statistics between two players, from player1's perspective"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with get_db_connection() as conn, conn.cursor() as cur:
     
-    cur.execute('''
-        WITH game_results AS (
-            -- Games where player1 is player1_id
-            SELECT 
-                player1_move as move,
-                CASE
-                    WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                          (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                          (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
-                    WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
-                          (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
-                          (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
-                    ELSE 'DRAW'
-                END as result,
-                player2_move as opponent_move
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_id = %s
-                AND player2_id = %s
-            UNION ALL
-            -- Games where player1 is player2_id (reverse perspective)
-            SELECT 
-                player2_move as move,
-                CASE
-                    WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
-                          (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
-                          (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
-                    WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
-                          (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
-                          (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
-                    ELSE 'DRAW'
-                END as result,
-                player1_move as opponent_move
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_id = %s
-                AND player2_id = %s
-        ),
-        move_stats AS (
-            SELECT 
-                move,
-                COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
-                COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
-                COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
-                COUNT(*) as total_games
-            FROM game_results
-            GROUP BY move
-        ),
-        opponent_moves AS (
+        cur.execute('''
+            WITH game_results AS (
+                -- Games where player1 is player1_id
+                SELECT 
+                    player1_move as move,
+                    CASE
+                        WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
+                              (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
+                              (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
+                        WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
+                              (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
+                              (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
+                        ELSE 'DRAW'
+                    END as result,
+                    player2_move as opponent_move
+                FROM games
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND player1_id = %s
+                    AND player2_id = %s
+                UNION ALL
+                -- Games where player1 is player2_id (reverse perspective)
+                SELECT 
+                    player2_move as move,
+                    CASE
+                        WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
+                              (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
+                              (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
+                        WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
+                              (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
+                              (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
+                        ELSE 'DRAW'
+                    END as result,
+                    player1_move as opponent_move
+                FROM games
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    AND player1_id = %s
+                    AND player2_id = %s
+            ),
+            move_stats AS (
+                SELECT 
+                    move,
+                    COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
+                    COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
+                    COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
+                    COUNT(*) as total_games
+                FROM game_results
+                GROUP BY move
+            ),
+            opponent_moves AS (
+                SELECT 
+                    opponent_move,
+                    COUNT(*) as times_played
+                FROM game_results
+                GROUP BY opponent_move
+                ORDER BY COUNT(*) DESC
+                LIMIT 1
+            )
             SELECT 
-                opponent_move,
-                COUNT(*) as times_played
-            FROM game_results
-            GROUP BY opponent_move
-            ORDER BY COUNT(*) DESC
-            LIMIT 1
-        )
-        SELECT 
-            m.move,
-            m.wins,
-            m.losses,
-            m.draws,
-            m.total_games,
-            o.opponent_move as most_played_move,
-            o.times_played
-        FROM move_stats m
-        CROSS JOIN opponent_moves o
-        ORDER BY m.total_games DESC
-    ''', (player1_id, player2_id, player2_id, player1_id))
+                m.move,
+                m.wins,
+                m.losses,
+                m.draws,
+                m.total_games,
+                o.opponent_move as most_played_move,
+                o.times_played
+            FROM move_stats m
+            CROSS JOIN opponent_moves o
+            ORDER BY m.total_games DESC
+        ''', (player1_id, player2_id, player2_id, player1_id))
     
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
+        results = cur.fetchall()
     
     if not results:
         return None
@@ -770,77 +919,74 @@ def get_head_to_head_stats(player1_id, player2_id):
 def get_move_stats_breakdown(user_id=None):
     """Get statistics about moves played in the current year, broken down by play order.
     If user_id is provided, only get stats for that specific user."""
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with get_db_connection() as conn, conn.cursor() as cur:
     
-    query = '''
-        WITH first_player_moves AS (
-            SELECT 
-                player1_move as move,
-                'FIRST' as play_order,
-                CASE
-                    WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                          (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                          (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
-                    WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
-                          (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
-                          (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
-                    ELSE 'DRAW'
-                END as result
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                {}
-        ),
-        second_player_moves AS (
+        query = '''
+            WITH first_player_moves AS (
+                SELECT 
+                    player1_move as move,
+                    'FIRST' as play_order,
+                    CASE
+                        WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
+                              (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
+                              (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
+                        WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
+                              (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
+                              (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
+                        ELSE 'DRAW'
+                    END as result
+                FROM games
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    {}
+            ),
+            second_player_moves AS (
+                SELECT 
+                    player2_move as move,
+                    'SECOND' as play_order,
+                    CASE
+                        WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
+                              (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
+                              (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
+                        WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
+                              (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
+                              (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
+                        ELSE 'DRAW'
+                    END as result
+                FROM games
+                WHERE status = 'complete'
+                    AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
+                    {}
+            ),
+            all_moves AS (
+                SELECT * FROM first_player_moves
+                UNION ALL
+                SELECT * FROM second_player_moves
+            )
             SELECT 
-                player2_move as move,
-                'SECOND' as play_order,
-                CASE
-                    WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
-                          (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
-                          (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
-                    WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
-                          (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
-                          (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
-                    ELSE 'DRAW'
-                END as result
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                {}
-        ),
-        all_moves AS (
-            SELECT * FROM first_player_moves
-            UNION ALL
-            SELECT * FROM second_player_moves
-        )
-        SELECT 
-            move,
-            play_order,
-            COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
-            COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
-            COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
-            COUNT(*) as total_games
-        FROM all_moves
-        GROUP BY move, play_order
-        ORDER BY move, play_order
-    '''
+                move,
+                play_order,
+                COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
+                COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
+                COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
+                COUNT(*) as total_games
+            FROM all_moves
+            GROUP BY move, play_order
+            ORDER BY move, play_order
+        '''
     
-    if user_id:
-        query = query.format(
-            'AND player1_id = %s',
-            'AND player2_id = %s'
-        )
-        params = [user_id, user_id]
-    else:
-        query = query.format('', '')
-        params = []
+        if user_id:
+            query = query.format(
+                'AND player1_id = %s',
+                'AND player2_id = %s'
+            )
+            params = [user_id, user_id]
+        else:
+            query = query.format('', '')
+            params = []
     
-    cur.execute(query, params)
-    results = cur.fetchall()
-    cur.close()
-    conn.close()
+        cur.execute(query, params)
+        results = cur.fetchall()
     
     if not results:
         return None
@@ -866,105 +1012,15 @@ def get_move_stats_breakdown(user_id=None):
 
 def get_head_to_head_stats_breakdown(player1_id, player2_id):
     """Get head-to-head statistics between two players with first/second player breakdown"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute('''
-        WITH game_results AS (
-            -- Games where player1 is first player
-            SELECT 
-                player1_move as move,
-                'FIRST' as play_order,
-                CASE
-                    WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
-                          (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
-                          (player1_move = 'SCISSORS' AND player2_move = 'PAPER')) THEN 'WIN'
-                    WHEN ((player1_move = 'ROCK' AND player2_move = 'PAPER') OR
-                          (player1_move = 'PAPER' AND player2_move = 'SCISSORS') OR
-                          (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
-                    ELSE 'DRAW'
-                END as result,
-                player2_move as opponent_move
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_id = %s
-                AND player2_id = %s
-            UNION ALL
-            -- Games where player1 is second player
-            SELECT 
-                player2_move as move,
-                'SECOND' as play_order,
-                CASE
-                    WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
-                          (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
-                          (player2_move = 'SCISSORS' AND player1_move = 'PAPER')) THEN 'WIN'
-                    WHEN ((player2_move = 'ROCK' AND player1_move = 'PAPER') OR
-                          (player2_move = 'PAPER' AND player1_move = 'SCISSORS') OR
-                          (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
-                    ELSE 'DRAW'
-                END as result,
-                player1_move as opponent_move
-            FROM games
-            WHERE status = 'complete'
-                AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND player1_id = %s
-                AND player2_id = %s
-        ),
-        move_stats AS (
-            SELECT 
-                move,
-                play_order,
-                COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
-                COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
-                COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
-                COUNT(*) as total_games
-            FROM game_results
-            GROUP BY move, play_order
-        )
-        SELECT 
-            m.move,
-            m.play_order,
-            m.wins,
-            m.losses,
-            m.draws,
-            m.total_games
-        FROM move_stats m
-        ORDER BY m.move, m.play_order
-    ''', (player1_id, player2_id, player2_id, player1_id))
-
-    results = cur.fetchall()
-    cur.close()
-
-    if not results:
-        return None
-
-    total_games = sum(row[5] for row in results)
-
-    # Group results by move
-    stats = {}
-    for row in results:
-        move, play_order, wins, losses, draws, total = row[0:6]
-        if move not in stats:
-            stats[move] = {'first': None, 'second': None}
-
-        order_key = 'first' if play_order == 'FIRST' else 'second'
-        stats[move][order_key] = {
-            'wins': wins,
-            'losses': losses,
-            'draws': draws,
-            'total_games': total,
-            'win_rate': round(wins / total * 100, 1) if total > 0 else 0
-        }
-
-    cur = conn.cursor()
-
-    cur.execute('''
+    with get_db_connection() as conn, conn.cursor() as cur:
+        # player1's moves and the opponent's moves are aggregated from the same games in a single
+        # round trip, rows are told apart by their kind
+        cur.execute('''
             WITH game_results AS (
                 -- Games where player1 is first player
                 SELECT 
                     player1_move as move,
-                    'SECOND' as play_order,
+                    'FIRST' as play_order,
                     CASE
                         WHEN ((player1_move = 'ROCK' AND player2_move = 'SCISSORS') OR
                               (player1_move = 'PAPER' AND player2_move = 'ROCK') OR
@@ -974,7 +1030,8 @@ def get_head_to_head_stats_breakdown(player1_id, player2_id):
                               (player1_move = 'SCISSORS' AND player2_move = 'ROCK')) THEN 'LOSS'
                         ELSE 'DRAW'
                     END as result,
-                    player2_move as opponent_move
+                    player2_move as opponent_move,
+                    'SECOND' as opponent_play_order
                 FROM games
                 WHERE status = 'complete'
                     AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
@@ -984,7 +1041,7 @@ def get_head_to_head_stats_breakdown(player1_id, player2_id):
                 -- Games where player1 is second player
                 SELECT 
                     player2_move as move,
-                    'FIRST' as play_order,
+                    'SECOND' as play_order,
                     CASE
                         WHEN ((player2_move = 'ROCK' AND player1_move = 'SCISSORS') OR
                               (player2_move = 'PAPER' AND player1_move = 'ROCK') OR
@@ -994,41 +1051,87 @@ def get_head_to_head_stats_breakdown(player1_id, player2_id):
                               (player2_move = 'SCISSORS' AND player1_move = 'ROCK')) THEN 'LOSS'
                         ELSE 'DRAW'
                     END as result,
-                    player1_move as opponent_move
+                    player1_move as opponent_move,
+                    'FIRST' as opponent_play_order
                 FROM games
                 WHERE status = 'complete'
                     AND EXTRACT(YEAR FROM created_at) = EXTRACT(YEAR FROM CURRENT_DATE)
                     AND player1_id = %s
                     AND player2_id = %s
-            )
-             SELECT
-                    opponent_move,
+            ),
+            move_stats AS (
+                SELECT 
+                    move,
                     play_order,
+                    COUNT(CASE WHEN result = 'WIN' THEN 1 END) as wins,
+                    COUNT(CASE WHEN result = 'LOSS' THEN 1 END) as losses,
+                    COUNT(CASE WHEN result = 'DRAW' THEN 1 END) as draws,
+                    COUNT(*) as total_games
+                FROM game_results
+                GROUP BY move, play_order
+            ),
+            -- player1's win rate against each move of the opponent, by the opponent's play order
+            opponent_stats AS (
+                SELECT
+                    opponent_move,
+                    opponent_play_order,
                     COUNT(*) as times_played,
                     COALESCE(COUNT(CASE WHEN result = 'WIN' THEN 1 END)::float / NULLIF(COUNT(CASE WHEN result <> 'DRAW' THEN 1 END)::float, 0),0) as win_rate
                 FROM game_results
-                GROUP BY  play_order, opponent_move
-                ORDER BY win_rate DESC, times_played DESC
+                GROUP BY opponent_play_order, opponent_move
+            )
+            SELECT *
+            FROM (
+                SELECT 'MOVE' as kind, move, play_order, wins, losses, draws, total_games, NULL::float as win_rate
+                FROM move_stats
+                UNION ALL
+                SELECT 'OPPONENT', opponent_move, opponent_play_order, NULL, NULL, NULL, times_played, win_rate
+                FROM opponent_stats
+            ) combined
+            ORDER BY
+                kind,
+                CASE WHEN kind = 'MOVE' THEN move END,
+                CASE WHEN kind = 'MOVE' THEN play_order END,
+                win_rate DESC,
+                total_games DESC
         ''', (player1_id, player2_id, player2_id, player1_id))
+        rows = cur.fetchall()
+
+    results = [row[1:7] for row in rows if row[0] == 'MOVE']
+    if not results:
+        return None
+    # Opponent rows as (opponent_move, play_order, times_played, win_rate), best win rate first
+    opponent_results = [(row[1], row[2], row[6], row[7]) for row in rows if row[0] == 'OPPONENT']
+
+    total_games = sum(row[5] for row in results)
+
+    # Group results by move
+    stats = {}
+    for row in results:
+        move, play_order, wins, losses, draws, total = row[0:6]
+        if move not in stats:
+            stats[move] = {'first': None, 'second': None}
+
+        order_key = 'first' if play_order == 'FIRST' else 'second'
+        stats[move][order_key] = {
+            'wins': wins,
+            'losses': losses,
+            'draws': draws,
+            'total_games': total,
+            'win_rate': round(wins / total * 100, 1) if total > 0 else 0
+        }
 
-    results = cur.fetchall()
-    
     # Sum times_played for each move across play orders
     move_totals = {}
-    for row in results:
+    for row in opponent_results:
         move = row[0]  # opponent_move
         times_played = row[2]  # times_played
         move_totals[move] = move_totals.get(move, 0) + times_played
-    print(move_totals)
     # Find the most played move
     opponent_move = max(move_totals.items(), key=lambda x: x[1])[0] if move_totals else None
     
-    best_opener = next((row[0] for row in results if row[1] == 'FIRST'), None)
-    best_counter = next((row[0] for row in results if row[1] == 'SECOND'), None)
-    
-    cur.close()
-
-    conn.close()
+    best_opener = next((row[0] for row in opponent_results if row[1] == 'FIRST'), None)
+    best_counter = next((row[0] for row in opponent_results if row[1] == 'SECOND'), None)
 
     return {
         'moves': stats,
@@ -1037,6 +1140,3 @@ def get_head_to_head_stats_breakdown(player1_id, player2_id):
         'best_opener': best_opener,
         'best_counter': best_counter,
     }
-
-
-
@@ -0,0 +1,23 @@
+import logging
+import os
+
+# Set once the root logger has been configured by this process
+_configured = False
+
+
+def _default_level():
+    """Log level from LOG_LEVEL, production only keeps warnings and errors by default"""
+    default = 'WARNING' if os.getenv('VERCEL_ENV') == 'production' else 'INFO'
+    return os.getenv('LOG_LEVEL', default).upper()
+
+
+def get_logger(name):
+    """Get a named logger, configuring the shared log format on first use"""
+    global _configured
+    if not _configured:
+        logging.basicConfig(
+            level=_default_level(),
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        _configured = True
+    return logging.getLogger(name)
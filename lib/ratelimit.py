@@ -0,0 +1,30 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """Thread-safe token buckets keyed by an arbitrary key, refilled with `rate` tokens per second up to `burst`"""
+
+    def __init__(self, rate, burst, maxsize=1024):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token for `key` if one is available, returning whether it was taken.
+        Never blocks, callers decide what to do with a refused call"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            # Evicted buckets start full again if their key comes back, they are the least recently used
+            # so only a burst over more than maxsize keys can let a key through early
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed
@@ -1,19 +1,202 @@
 import os
+import re
 import hmac
+import logging
 import hashlib
-from datetime import datetime
+import time
+from collections import namedtuple
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import orjson
+import urllib3
+
+from lib.ratelimit import RateLimiter
+
+logger = logging.getLogger('shifumi.slack')
+
+# Slack signatures are 'v0=' followed by a hex encoded SHA-256 digest
+SIGNATURE_LENGTH = len('v0=') + hashlib.sha256().digest_size * 2
+
+# Largest request body accepted from Slack
+MAX_BODY_SIZE = 64 * 1024
+
+# User mentions as sent in slash command texts, <@U123> or <@U123|name>
+MENTION_RE = re.compile(r'^<@([UW][A-Z0-9]+)(?:\|[^>]*)?>$')
+
+# Response heads are written by hand, with the protocol version of the stdlib handler.
+# The empty 200 acknowledging a command is the same on every request
+_PROTOCOL = BaseHTTPRequestHandler.protocol_version.encode('ascii')
+_ACK_HEADERS = _PROTOCOL + b' 200 OK\r\nContent-Type: application/json\r\nContent-Length: 0\r\n\r\n'
+
+# Keyed HMAC of the signing secret, copied for every signature check
+_signing_base = None
+
+# Messages to a response_url are posted in the background, once Slack has been acknowledged
+executor = ThreadPoolExecutor(max_workers=8)
+
+# Slack accepts about one message per second in a channel. Workers never wait for their turn,
+# messages over the limit are only shown to the user who asked. The buckets are per instance
+channel_limiter = RateLimiter(rate=1, burst=3)
+
+# Keep connections to Slack alive between requests served by this instance.
+# Connection errors and rate limited responses are retried, Slack did not take the message in those cases.
+# Read errors and 5xx responses are not: the message may already be posted
+# urllib3 is used directly, importing requests on top of it only slowed cold starts down
+_slack_http = urllib3.PoolManager(
+    maxsize=16,
+    timeout=5,
+    retries=urllib3.Retry(
+        total=2,
+        read=False,
+        backoff_factor=0.1,
+        status_forcelist=(429,),
+        allowed_methods=frozenset({'POST'}),
+    ),
+)
+
+
+def is_plausible_slack_request(timestamp, signature):
+    """Cheap checks on the signature headers, run before the body is read and hashed"""
+    if not timestamp or not signature:
+        return False
+    if len(signature) != SIGNATURE_LENGTH or not signature.startswith('v0='):
+        return False
+    try:
+        return abs(time.time() - int(timestamp)) <= 60 * 5
+    except ValueError:
+        return False
+
+
+def parse_mention(text):
+    """Get the user ID of a Slack user mention, None if the text is not a mention"""
+    match = MENTION_RE.match(text)
+    return match.group(1) if match else None
+
+
+def _signing_hmac():
+    """Fresh HMAC of the signing secret, None when no secret is configured.
+    The keyed state is built once per process and copied, so requests skip hashing the key pads"""
+    global _signing_base
+    if _signing_base is None:
+        secret = os.getenv('SLACK_SIGNING_SECRET')
+        if not secret:
+            return None
+        _signing_base = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+    return _signing_base.copy()
+
 
 def verify_slack_request(timestamp, body, signature):
-    """Verify that the request actually came from Slack"""
-    if abs(datetime.now().timestamp() - int(timestamp)) > 60 * 5:
+    """Verify that the request actually came from Slack.
+    The body should be the raw request bytes, str bodies are encoded first"""
+    # Stale (replayed) or malformed headers are rejected before computing the HMAC
+    if not is_plausible_slack_request(timestamp, signature):
         return False
 
-    sig_basestring = f"v0:{timestamp}:{body}".encode('utf-8')
-    my_signature = 'v0=' + hmac.new(
-        os.getenv('SLACK_SIGNING_SECRET').encode('utf-8'),
-        sig_basestring,
-        hashlib.sha256
-    ).hexdigest()
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    mac = _signing_hmac()
+    # Nothing can be verified without a signing secret
+    if mac is None:
+        return False
+    mac.update(f"v0:{timestamp}:".encode('utf-8'))
+    mac.update(body)
+    my_signature = 'v0=' + mac.hexdigest()
 
     return hmac.compare_digest(my_signature, signature)
 
+
+def read_slack_body(handler):
+    """Read the raw body of a request on a BaseHTTPRequestHandler, checking its Slack signature.
+    Signatures are checked in production and wherever a signing secret is configured.
+    Returns None when the request was rejected, an error response has already been sent in that case"""
+    signing_secret = os.getenv('SLACK_SIGNING_SECRET')
+    check_signature = os.getenv('VERCEL_ENV') == 'production' or bool(signing_secret)
+    # Production requests cannot be verified without a signing secret, that is a deployment error
+    if check_signature and not signing_secret:
+        logger.error('SLACK_SIGNING_SECRET is not set, rejecting request')
+        write_response(handler, 500)
+        return None
+
+    timestamp = handler.headers.get('X-Slack-Request-Timestamp')
+    signature = handler.headers.get('X-Slack-Signature')
+
+    # Malformed or stale signatures are rejected without reading the body
+    if check_signature and not is_plausible_slack_request(timestamp, signature):
+        write_response(handler, 401)
+        return None
+
+    # Slack payloads are a few KB at most, anything larger is not read at all
+    try:
+        content_length = int(handler.headers.get('Content-Length', 0))
+    except ValueError:
+        write_response(handler, 400)
+        return None
+    if content_length > MAX_BODY_SIZE:
+        write_response(handler, 413)
+        return None
+
+    body = handler.rfile.read(content_length)
+
+    # The signature is computed over the raw bytes, callers parse them with parse_slack_form
+    if check_signature and not verify_slack_request(timestamp, body, signature):
+        write_response(handler, 401)
+        return None
+    return body
+
+
+def parse_slack_form(body):
+    """Parse a form encoded Slack body into a dict, Slack sends a single value per parameter.
+    The raw body is plain ASCII with percent-escapes, so it is decoded without UTF-8 validation
+    and parse_qsl decodes the escaped values as UTF-8"""
+    return dict(parse_qsl(body.decode('latin-1'), keep_blank_values=True))
+
+
+# Fields of a slash command that the handlers use, the rest of the form is dropped
+SlashCommand = namedtuple('SlashCommand', 'user_id user_name channel_id channel_name text response_url')
+
+
+def parse_slash_command(body):
+    """Parse the form encoded body of a slash command into a SlashCommand, missing fields are empty.
+    Only the SlashCommand fields are kept while going over the form, no dict of every parameter is built"""
+    fields = dict.fromkeys(SlashCommand._fields, '')
+    for key, value in parse_qsl(body.decode('latin-1'), keep_blank_values=True):
+        if key in fields:
+            fields[key] = value
+    return SlashCommand(**fields)
+
+
+def write_response(handler, status=200, body=b''):
+    """Write a complete JSON response on a BaseHTTPRequestHandler, in a single write.
+    Content-Length is always set so the body does not need chunking or a closed connection.
+    The stdlib Server and Date headers and the access log line are skipped"""
+    if status == 200 and not body:
+        head = _ACK_HEADERS
+    else:
+        head = b'%s %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % (
+            _PROTOCOL, status, HTTPStatus(status).phrase.encode('ascii'), len(body)
+        )
+    handler.wfile.write(head + body)
+    handler.wfile.flush()
+
+
+def post_response(response_url, message, channel_id=None):
+    """Post a message to a Slack response_url.
+    The message is either a dict or an already serialized JSON body.
+    Messages to a channel_id count against its rate limit, they are posted ephemerally once it is reached"""
+    if channel_id and not channel_limiter.acquire(channel_id):
+        logger.warning('Channel %s rate limited, posting ephemerally', channel_id)
+        if not isinstance(message, dict):
+            message = orjson.loads(message)
+        # An ephemeral message cannot replace the original one in the channel
+        message = {**message, 'response_type': 'ephemeral', 'replace_original': False}
+    if isinstance(message, dict):
+        message = orjson.dumps(message)
+    return _slack_http.request(
+        'POST',
+        response_url,
+        body=message,
+        headers={'Content-Type': 'application/json'},
+    )
@@ -8,37 +8,46 @@ class Gesture(Enum):
     @property
     def emoji(self):
         """Return the emoji representation of the gesture"""
-        return {
-            self.ROCK: ":rock:",
-            self.PAPER: ":leaves:",
-            self.SCISSORS: ":scissors:"
-        }[self]
+        return GESTURE_EMOJIS[self]
 
     @classmethod
     def from_input(cls, text):
         """Convert various input formats to a Gesture"""
         text = text.upper().strip()
-        mapping = {
-            # Rock variations
-            "ROCK": cls.ROCK,
-            ":ROCK:": cls.ROCK,
-            "PIERRE": cls.ROCK,
-            "CAILLOU": cls.ROCK,
-            "CAILLOUX": cls.ROCK,
-            ":CAILLOU:": cls.ROCK,
-            # Paper variations
-            "PAPER": cls.PAPER,
-            "FEUILLE": cls.PAPER,
-            "FEUILLES": cls.PAPER,
-            ":LEAVES:": cls.PAPER,
-            ":FEUILLE:": cls.PAPER,
-            # Scissors variations
-            "SCISSORS": cls.SCISSORS,
-            "CISEAUX": cls.SCISSORS,
-            ":SCISSORS:": cls.SCISSORS,
-            ":CISEAUX:": cls.SCISSORS,
-        }
-        if text not in mapping:
+        gesture = GESTURE_INPUTS.get(text)
+        if gesture is None:
             raise ValueError(f"Invalid gesture: {text}")
-        return mapping[text]
+        return gesture
 
+
+# Emoji of each gesture, built once instead of on every emoji access
+GESTURE_EMOJIS = {
+    Gesture.ROCK: ":rock:",
+    Gesture.PAPER: ":leaves:",
+    Gesture.SCISSORS: ":scissors:",
+}
+
+# Gestures by their stored value, avoids going through Enum lookups for every game
+GESTURE_BY_VALUE = {gesture.value: gesture for gesture in Gesture}
+
+# Accepted spellings of each gesture, built once instead of on every from_input call
+GESTURE_INPUTS = {
+    # Rock variations
+    "ROCK": Gesture.ROCK,
+    ":ROCK:": Gesture.ROCK,
+    "PIERRE": Gesture.ROCK,
+    "CAILLOU": Gesture.ROCK,
+    "CAILLOUX": Gesture.ROCK,
+    ":CAILLOU:": Gesture.ROCK,
+    # Paper variations
+    "PAPER": Gesture.PAPER,
+    "FEUILLE": Gesture.PAPER,
+    "FEUILLES": Gesture.PAPER,
+    ":LEAVES:": Gesture.PAPER,
+    ":FEUILLE:": Gesture.PAPER,
+    # Scissors variations
+    "SCISSORS": Gesture.SCISSORS,
+    "CISEAUX": Gesture.SCISSORS,
+    ":SCISSORS:": Gesture.SCISSORS,
+    ":CISEAUX:": Gesture.SCISSORS,
+}